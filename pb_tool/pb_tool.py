@@ -21,20 +21,136 @@ __author__ = 'gsherman'
 
 import os
 import sys
+import ast
+import json
+import hashlib
 import subprocess
 import shutil
+import re
+import time
+import zlib
 import errno
-import glob
+import zipfile
+import imp
+import struct
+import py_compile
+import threading
+import signal
+import socket
+import SocketServer
+import ctypes
+import __builtin__
+import fnmatch
+import math
+import tempfile
+import contextlib
+import mmap
+import collections
+import traceback
 import ConfigParser
+import tarfile
+import xml.etree.cElementTree as ElementTree
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
 from string import Template
-from distutils.dir_util import copy_tree
+from StringIO import StringIO
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 import click
 
+# Directory used for build manifests and caches
+MANIFEST_DIR = '.pb_tool'
+
+# Deploy copies overlap on this many threads; files move through the
+# kernel in chunks of KERNEL_COPY_CHUNK or through a COPY_BUFFER buffer
+COPY_THREADS = 8
+KERNEL_COPY_CHUNK = 1 << 30
+COPY_BUFFER = 1 << 20
+_kernel_copy = {}
+
+# Removed deployments are renamed into a temporary directory with this
+# prefix beside the plugins directory (where QGIS doesn't look for
+# plugins), which is deleted in the background
+TRASH_PREFIX = '.pb_tool-trash-'
+
+# Step metrics of each command run are kept in this database in the
+# .pb_tool directory
+METRICS_DB = 'metrics.db'
+_metrics = {'command': None, 'started': None, 'db': None, 'steps': []}
+
+# pep8 checks the check command skips unless the config sets pep8_ignore
+# in the [check] section (as in the sample Makefile)
+PEP8_IGNORE = 'E203,E121,E122,E123,E124,E125,E126,E127,E128'
+
+# Local port the reload listener in QGIS accepts requests on unless the
+# config sets reload_port in the [deploy] section
+RELOAD_PORT = 9967
+
+# Deploy targets of the form tar:<file>, tar.gz:<file> or tar.bz2:<file>
+# stream the plugin as a tar archive to the file (- for stdout)
+STREAM_TARGET = re.compile(r'^tar(?:\.(gz|bz2))?:(.+)$')
+STREAM_CHUNK = 1 << 20
+
+# Locks held by this process: path -> [open lock file, depth]. Locks are
+# reentrant within the process, so nested steps can take them again.
+_locks = {}
+_locks_guard = threading.RLock()
+
+# Locks shared by all of a user's projects (those of deploy targets) are
+# kept in this directory
+USER_LOCK_DIR = os.path.join('~', '.pb_tool', 'locks')
+
+# The lock hierarchy: runs take locks in this order (deploy target locks
+# first, then the locks of the .pb_tool manifests), so a run holding a lock
+# only ever waits for one further down the list (see locked)
+LOCK_ORDER = ['target', 'check', 'manifest', 'strings', 'translate',
+              'compile', 'bytecode', 'package', 'deploy', 'stat_index']
+# Content hashes are kept in this manifest, keyed by the stat of each
+# file. Files changed less than RACY_SECONDS before they were hashed
+# aren't recorded, as a later change within the timestamp resolution of
+# the file system could leave their stat as it was. Files of at least
+# MMAP_THRESHOLD bytes are hashed through mmap, HASH_THREADS at a time.
+STAT_INDEX = 'stat_index'
+RACY_SECONDS = 2.0
+MMAP_THRESHOLD = 1 << 20
+HASH_THREADS = 4
+# The stat index of each .pb_tool directory used by this run, and the
+# entries changed in it (None for files that are gone), which
+# save_stat_index writes when the command ends
+_stat_index = {}
+_stat_updates = {}
+
+# Generated files get the permissions a plain open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+
 
 @click.group()
-def cli():
+@click.pass_context
+def cli(ctx):
     """Simple Python tool to compile and deploy a QGIS plugin.
     For help on a command use --help after the command:
     pb_tool deploy --help.
@@ -46,7 +162,9 @@ def cli():
     See http://g-sherman.github.io/plugin_build_tool for for an example config
     file. You can also use the create command to generate a best-guess config
     file for an existing project, then tweak as needed."""
-    pass
+    start_metrics(ctx.invoked_subcommand)
+    ctx.call_on_close(save_metrics)
+    ctx.call_on_close(save_stat_index)
 
 
 def get_install_files(cfg):
@@ -71,109 +189,924 @@ def version():
 @click.option('--quick', '-q', is_flag=True,
               help='Do a quick install without compiling ui, resource, docs, \
               and translation files')
-def deploy(config, quick):
+@click.option('--target', '-t', multiple=True,
+              help='Plugin directory to deploy to, or tar:FILE, tar.gz:FILE \
+              or tar.bz2:FILE to stream a tar archive to FILE (- for stdout). \
+              May be repeated. Overrides the targets in the [deploy] section \
+              of the config')
+@click.option('--bytecode', '-b', is_flag=True,
+              help='Byte-compile the deployed Python files')
+@click.option('--plan', is_flag=True,
+              help='Print what would be removed, compiled and copied \
+              without doing it')
+@click.option('--reload/--no-reload', default=None,
+              help='Ask QGIS to reload the plugin after deploying (default: \
+              the reload option in the [deploy] section of the config)')
+@click.option('--check/--no-check', default=None,
+              help='Run pb_tool check first and stop if it finds problems \
+              (default: the gate option in the [check] section of the config)')
+def deploy(config, quick, target, bytecode, plan, reload, check):
     """Deploy the plugin to QGIS plugin directory using parameters in pb_tool.cfg"""
-    deploy_files(config, quick)
+    if plan:
+        if os.path.exists(config):
+            plan_deploy(get_config(config), quick, target, bytecode)
+        else:
+            click.secho("Configuration file {0} is missing.".format(config), fg='red')
+        return
+    deploy_files(config, quick, target, bytecode, reload, check)
 
 
-def deploy_files(config, quick=False):
+def deploy_files(config, quick=False, targets=(), bytecode=False, reload=None,
+                 check=None):
     """Deploy the plugin using parameters in pb_tool.cfg"""
     # check for the config file
     if not os.path.exists(config):
         click.secho("Configuration file {0} is missing.".format(config), fg='red')
     else:
         cfg = get_config(config)
-        plugin_dir = os.path.join(get_plugin_directory(), cfg.get('plugin', 'name'))
+        streams = get_stream_targets(cfg, targets)
+        plugin_dirs = get_deploy_targets(cfg, targets, default=not streams)
+        # A tar stream on stdout gets stdout to itself; messages go to stderr
+        stdout = sys.stdout
+        if any(path == '-' for (path, compression) in streams):
+            sys.stdout = sys.stderr
+        try:
+            deploy_plugin(cfg, config, plugin_dirs, streams, stdout, quick,
+                          bytecode, reload, check)
+        finally:
+            sys.stdout = stdout
+
+
+def deploy_plugin(cfg, config, plugin_dirs, streams, stdout, quick=False,
+                  bytecode=False, reload=None, check=None):
+    """ Deploy the plugin to the plugin directories and tar streams """
+    with locked(*[target_lock(plugin_dir) for plugin_dir in plugin_dirs]):
+        if not check_gate(cfg, check):
+            sys.exit(1)
+        collect_trash(plugin_dirs)
         if quick:
             click.secho("Doing quick deployment", fg='green')
-            install_files(plugin_dir, cfg)
+            deploy_to(plugin_dirs, cfg, bytecode)
+            deploy_streams(streams, cfg, stdout, bytecode)
             click.secho("Quick deployment complete---if you have problems with your"
                    " plugin, try doing a full deploy.", fg='green')
+            if reload_enabled(cfg) if reload is None else reload:
+                report_reload(cfg)
 
         else:
             print """Deploying will:
-            * Remove your currently deployed version
-            * Compile the ui and resource files
-            * Build the help docs
-            * Copy everything to your .qgis2/python/plugins directory
-            """
+                * Remove your currently deployed version
+                * Compile the ui and resource files
+                * Build the help docs
+                * Copy everything to:"""
+            for plugin_dir in plugin_dirs:
+                print "                {0}".format(plugin_dir)
+            for (path, compression) in streams:
+                print "                {0} (tar{1} stream)".format(
+                    path, '.' + compression if compression else '')
+            print ""
 
             if click.confirm("Proceed?"):
 
                 # clean the deployment
-                clean_deployment(False, config)
-                click.secho("Deploying to {0}".format(plugin_dir), fg='green')
+                start = time.time()
+                for plugin_dir in plugin_dirs:
+                    clean_deployment(False, config, plugin_dir)
+                record_step('clean', time.time() - start, len(plugin_dirs))
+                click.secho("Deploying to {0}".format(', '.join(
+                    plugin_dirs + [path for (path, compression) in streams])),
+                    fg='green')
                 # compile to make sure everything is fresh
                 click.secho('Compiling to make sure install is clean', fg='green')
                 compile_files(cfg)
                 build_docs()
-                install_files(plugin_dir, cfg)
+                deploy_to(plugin_dirs, cfg, bytecode)
+                deploy_streams(streams, cfg, stdout, bytecode)
+                if reload_enabled(cfg) if reload is None else reload:
+                    report_reload(cfg)
 
 
-def install_files(plugin_dir, cfg):
-        errors = []
-        install_files = get_install_files(cfg)
-        # make the plugin directory if it doesn't exist
-        if not os.path.exists(plugin_dir):
-            os.mkdir(plugin_dir)
-
-        fail = False
-        for file in install_files:
-            click.secho("Copying {0}".format(file), fg='magenta', nl=False)
-            try:
-                shutil.copy(file, os.path.join(plugin_dir, file))
-                print ""
-            except Exception as oops:
-                errors.append("Error copying files: {0}, {1}".format(
-                    file, oops.strerror))
-                click.echo(click.style(' ----> ERROR', fg='red'))
-                fail = True
-            extra_dirs = cfg.get('files', 'extra_dirs').split()
-            #print "EXTRA DIRS: {}".format(extra_dirs)
-        for xdir in extra_dirs:
-            click.secho("Copying contents of {0} to {1}".format(xdir,
-                plugin_dir), fg='magenta', nl=False)
+def get_deploy_targets(cfg, targets=(), default=True):
+    """ Return the plugin directories to deploy to. Targets given on the
+    command line take precedence over the targets in the [deploy] section
+    of the config, which in turn override the default QGIS plugin
+    directory (unless default is False). Tar stream targets are left
+    out. """
+    name = cfg.get('plugin', 'name')
+    dirs = [d for d in targets or cfg_get(cfg, 'deploy', 'targets').split()
+            if not STREAM_TARGET.match(d)]
+    if not dirs and default:
+        dirs = [get_plugin_directory()]
+    return [os.path.join(os.path.expanduser(os.path.expandvars(d)), name)
+            for d in dirs]
+
+
+def get_stream_targets(cfg, targets=()):
+    """ Return the tar stream targets among the deploy targets as (path,
+    compression) pairs. The path is - for stdout and compression is gz,
+    bz2 or None; for tar:<file> it is taken from the file extension. """
+    streams = []
+    for target in targets or cfg_get(cfg, 'deploy', 'targets').split():
+        match = STREAM_TARGET.match(target)
+        if match:
+            (compression, path) = match.groups()
+            if path != '-':
+                path = os.path.expanduser(os.path.expandvars(path))
+                if not compression and path.endswith(('.gz', '.tgz')):
+                    compression = 'gz'
+                elif not compression and path.endswith(('.bz2', '.tbz2')):
+                    compression = 'bz2'
+            streams.append((path, compression))
+    return streams
+
+
+def deploy_to(plugin_dirs, cfg, bytecode=False):
+    """ Install the plugin into one or more plugin directories """
+    if not plugin_dirs:
+        return
+    if len(plugin_dirs) == 1:
+        install_files(plugin_dirs[0], cfg)
+    else:
+        install_targets(plugin_dirs, cfg)
+    if bytecode:
+        for plugin_dir in plugin_dirs:
+            compile_bytecode(plugin_dir)
+
+
+def compile_bytecode(plugin_dir, jobs=0):
+    """ Byte-compile the Python files of a deployed plugin across a pool
+    of processes, so QGIS doesn't have to on read-only installs. Only
+    modules whose source hash changed since they were last compiled, or
+    whose .pyc is missing or out of date, are compiled. """
+    start = time.time()
+    with locked(lock_path('bytecode')):
+        manifest = read_manifest('bytecode')
+        key = os.path.abspath(plugin_dir)
+        recorded = manifest.get(key, {})
+        modules = [os.path.join(dirpath, fname)
+                   for dirpath, dirnames, filenames in os.walk(plugin_dir)
+                   for fname in filenames if fname.endswith('.py')]
+        hashes = {}
+        stale = []
+        for (path, digest) in sorted(hash_files(modules).items()):
+            rel = os.path.relpath(path, plugin_dir)
+            hashes[rel] = digest
+            if recorded.get(rel) != digest or not bytecode_current(path):
+                stale.append(path)
+        failed = []
+        if stale:
+            pool = Pool(min(jobs or cpu_count(), len(stale)))
             try:
-                copy_tree(xdir, "{0}/{1}".format(plugin_dir, xdir))
-                print ""
-            except Exception as oops:
-                errors.append("Error copying directory: {0}, {1}".format(
-                    xdir, oops.message))
-                click.echo(click.style(' ----> ERROR', fg='red'))
-                fail = True
-        help_src = cfg.get('help', 'dir')
-        help_target = os.path.join(
-            get_plugin_directory(),
-            cfg.get('plugin', 'name'),
-            cfg.get('help', 'target'))
-        click.secho("Copying {0} to {1}".format(help_src, help_target),
-            fg='magenta', nl=False)
-        #shutil.copytree(help_src, help_target)
+                results = pool.map(byte_compile, stale)
+            finally:
+                pool.close()
+            for (i, error) in enumerate(results):
+                if error:
+                    failed.append(os.path.relpath(stale[i], plugin_dir))
+                    click.secho(error, fg='red')
+        manifest[key] = dict((rel, digest) for (rel, digest) in hashes.items()
+                             if rel not in failed)
+        write_manifest(manifest, 'bytecode')
+    record_step('bytecode', time.time() - start, len(hashes), 0,
+                len(hashes) - len(stale), len(stale))
+    click.secho("Byte-compiled {0} of {1} modules in {2}".format(
+        len(stale) - len(failed), len(hashes), plugin_dir), fg='green')
+
+
+def byte_compile(path):
+    """ Byte-compile path, returning an error message or None. The .pyc is
+    written beside it and renamed into place. """
+    (fd, tmp) = temp_file(path + 'c')
+    os.close(fd)
+    try:
+        py_compile.compile(path, cfile=tmp, doraise=True)
+        replace_file(tmp, path + 'c')
+    except py_compile.PyCompileError as oops:
+        discard_file(tmp)
+        return oops.msg
+    except (IOError, OSError) as oops:
+        discard_file(tmp)
+        return '{0}: {1}'.format(path, oops.strerror or oops)
+    return None
+
+
+def bytecode_current(path):
+    """ Return True if the .pyc for path exists and was compiled from
+    the current version of path """
+    try:
+        with open(path + 'c', 'rb') as pyc:
+            header = pyc.read(8)
+    except IOError:
+        return False
+    return (header[:4] == imp.get_magic() and
+            struct.unpack('<I', header[4:8])[0] ==
+            int(os.stat(path).st_mtime) & 0xffffffff)
+
+
+def install_files(plugin_dir, cfg):
+    start = time.time()
+    items, errors = install_set(cfg)
+    identities = deploy_identities(cfg, items)
+    recorded = read_manifest('deploy').get(os.path.abspath(plugin_dir), {})
+    report = sync_target(plugin_dir, items, echo=True, recorded=recorded,
+                         identities=identities)
+    record_deployment([report])
+    record_step('copy', time.time() - start, len(items), report['bytes'],
+                report['unchanged'], report['copied'])
+    click.secho("Copied {0} files, {1} ({2} unchanged)".format(
+        report['copied'], format_rate(report['bytes'], report['seconds']),
+        report['unchanged']), fg='green')
+    report_errors(errors + report['errors'])
+
+
+def install_targets(plugin_dirs, cfg):
+    """ Sync the plugin to several plugin directories concurrently and
+    print a report for each """
+    start = time.time()
+    items, errors = install_set(cfg)
+    identities = deploy_identities(cfg, items)
+    manifest = read_manifest('deploy')
+    pool = ThreadPool(len(plugin_dirs))
+    try:
+        reports = pool.map(
+            lambda plugin_dir: sync_target(
+                plugin_dir, items, recorded=manifest.get(
+                    os.path.abspath(plugin_dir), {}), identities=identities),
+            plugin_dirs)
+    finally:
+        pool.close()
+    record_deployment(reports)
+    record_step('copy', time.time() - start, len(items) * len(reports),
+                sum(report['bytes'] for report in reports),
+                sum(report['unchanged'] for report in reports),
+                sum(report['copied'] for report in reports))
+    for report in reports:
+        click.secho("{0}: {1} copied ({2}), {3} unchanged, {4} errors".format(
+            report['target'], report['copied'],
+            format_rate(report['bytes'], report['seconds']),
+            report['unchanged'], len(report['errors'])),
+            fg='red' if report['errors'] else 'green')
+        errors.extend(report['errors'])
+    report_errors(errors)
+
+
+def deploy_streams(streams, cfg, stdout=None, bytecode=False):
+    """ Write the plugin as a tar archive to each stream target, without
+    staging it on disk. stdout is the stream for the - target. """
+    if not streams:
+        return
+    if bytecode:
+        click.secho("Tar streams are not byte-compiled", fg='yellow')
+    if bz2 is None and any(compression == 'bz2'
+                           for (path, compression) in streams):
+        click.secho("bz2 compression is not available in this Python",
+                    fg='red')
+        sys.exit(1)
+    items, errors = install_set(cfg)
+    name = cfg.get('plugin', 'name')
+    for (path, compression) in streams:
+        start = time.time()
         try:
-            copy_tree(help_src, help_target)
-            print ""
-        except Exception as oops:
-            errors.append("Error copying help files: {0}, {1}".format(
-                help_src, oops.message))
-            click.echo(click.style(' ----> ERROR', fg='red'))
-            fail = True
-        if fail:
-            print "\nERRORS:"
-            for error in errors:
-                print error
+            if path == '-':
+                written = write_stream(stdout or sys.stdout, items, name,
+                                       compression)
+            else:
+                with atomic_write(path) as out:
+                    written = write_stream(out, items, name, compression)
+        except (IOError, OSError) as oops:
+            errors.append("Error streaming to {0}: {1}".format(
+                path, oops.strerror or oops))
+            continue
+        seconds = time.time() - start
+        record_step('stream', seconds, len(items), written)
+        click.secho("Streamed {0} files to {1}, {2}".format(
+            len(items), 'stdout' if path == '-' else path,
+            format_rate(written, seconds)), fg='green')
+    report_errors(errors)
+
+
+def write_stream(out, items, arc_root, compression=None):
+    """ Write the tar archive of the items to out.
+
+    :returns: the number of bytes written
+    """
+    written = 0
+    for chunk in compress_stream(tar_stream(items, arc_root), compression):
+        out.write(chunk)
+        written += len(chunk)
+    out.flush()
+    return written
+
+
+def tar_stream(items, arc_root):
+    """ Generate the blocks of an (uncompressed) tar archive of the
+    (source, target) items below arc_root, reading each file in chunks so
+    memory use doesn't depend on the size of the plugin. Directory entries
+    are generated before the first file in them. """
+    now = int(time.time())
+    dirs = set()
+    for (source, target) in items:
+        parts = [arc_root] + target.replace(os.sep, '/').split('/')
+        for i in range(1, len(parts)):
+            dirname = '/'.join(parts[:i])
+            if dirname not in dirs:
+                dirs.add(dirname)
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0755
+                info.mtime = now
+                yield info.tobuf()
+        src_stat = os.stat(source)
+        info = tarfile.TarInfo('/'.join(parts))
+        info.size = src_stat.st_size
+        info.mode = src_stat.st_mode & 07777
+        info.mtime = int(src_stat.st_mtime)
+        yield info.tobuf()
+        remaining = info.size
+        with open(source, 'rb') as f:
+            while remaining:
+                chunk = f.read(min(STREAM_CHUNK, remaining))
+                if not chunk:
+                    # the file shrank: keep the size in the header
+                    chunk = '\0' * min(STREAM_CHUNK, remaining)
+                remaining -= len(chunk)
+                yield chunk
+        if info.size % tarfile.BLOCKSIZE:
+            yield '\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    # two empty blocks end the archive, padded to a full record
+    yield '\0' * tarfile.RECORDSIZE
+
+
+def compress_stream(blocks, compression=None):
+    """ Generate the blocks compressed with gzip (gz) or bzip2 (bz2), or
+    unchanged if compression is None """
+    if not compression:
+        for block in blocks:
+            yield block
+        return
+    if compression == 'gz':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = bz2.BZ2Compressor()
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def install_set(cfg):
+    """ Resolve the files to be deployed.
+
+    :returns: a list of (source, target) pairs, where target is relative
+        to the plugin directory, and a list of errors for sources that
+        don't exist
+    """
+    items = []
+    errors = []
+    for file in get_install_files(cfg):
+        if os.path.isfile(file):
+            items.append((file, file))
+        else:
+            errors.append("Error copying files: {0}, {1}".format(
+                file, os.strerror(errno.ENOENT)))
+    for xdir in cfg_get(cfg, 'files', 'extra_dirs').split():
+        if os.path.isdir(xdir):
+            items.extend(tree_files(xdir, xdir, copy_rules(cfg, 'files')))
+        else:
+            errors.append("Error copying directory: {0}, {1}".format(
+                xdir, os.strerror(errno.ENOENT)))
+    help_src = cfg.get('help', 'dir')
+    if os.path.isdir(help_src):
+        items.extend(tree_files(help_src, cfg.get('help', 'target'),
+                                copy_rules(cfg, 'help')))
+    else:
+        errors.append("Error copying help files: {0}, {1}".format(
+            help_src, os.strerror(errno.ENOENT)))
+    return items, errors
+
+
+def tree_files(source, target, rules=((), ())):
+    """ Return (source, target) pairs for every file below the source
+    directory that isn't excluded by the (exclude, include) rules. Excluded
+    directories are not descended into. """
+    (exclude, include) = rules
+    items = []
+    for path in sorted(walk_tree(source, exclude)):
+        if include and not is_included(path, include):
+            continue
+        parts = path.split('/')
+        items.append((os.path.join(source, *parts),
+                      os.path.normpath(os.path.join(target, *parts))))
+    return items
+
+
+# Exclude rules for the extra_dirs ([files] section) and the help
+# directory ([help] section) when the config doesn't set its own
+DEFAULT_COPY_EXCLUDE = {
+    'files': '.git .svn .hg __pycache__ *.pyc *.pyo *~ *.swp .DS_Store',
+    'help': '.doctrees .buildinfo',
+}
+
+
+def copy_rules(cfg, section):
+    """ Return the (exclude, include) rules for the directories copied by
+    a config section, from its exclude and include options. Both hold
+    .gitignore style patterns relative to the copied directory; when
+    include is set only files matching it are copied. """
+    exclude = cfg_get(cfg, section, 'exclude', DEFAULT_COPY_EXCLUDE[section])
+    include = cfg_get(cfg, section, 'include')
+    return ([ignore_rule(line) for line in exclude.split()],
+            [ignore_rule(line) for line in include.split()])
+
+
+def package_filter(cfg, bytecode=False):
+    """ Return a function telling whether a path (relative to the deployed
+    plugin, using / as separator) is excluded by the copy rules of the
+    directory it was deployed from. With bytecode, .pyc and .pyo files
+    follow their source. """
+    sections = [(xdir, copy_rules(cfg, 'files'))
+                for xdir in cfg_get(cfg, 'files', 'extra_dirs').split()]
+    sections.append((cfg_get(cfg, 'help', 'target'), copy_rules(cfg, 'help')))
+    sections = [(os.path.normpath(prefix).replace(os.sep, '/') + '/', rules)
+                for (prefix, rules) in sections if prefix]
+
+    def excluded(path, is_dir):
+        if bytecode and path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        for (prefix, (exclude, include)) in sections:
+            if path.startswith(prefix):
+                rel = path[len(prefix):]
+                return (is_ignored(rel, is_dir, exclude) or
+                        bool(include and not is_dir and
+                             not is_included(rel, include)))
+        return False
+    return excluded
+
+
+def sync_target(plugin_dir, items, echo=False, recorded=None, identities=None):
+    """ Copy the (source, target) items into plugin_dir, skipping files
+    whose size and modification time already match. When the content
+    identities of the sources are given, files whose identity is the same
+    as when they were deployed (according to the recorded deploy manifest
+    entries) are skipped even if their modification time changed.
+
+    The files to be copied are copied concurrently by copy_files.
+
+    :returns: a report dict with the number of files copied and unchanged,
+        the bytes copied and the seconds spent copying them, a list of
+        errors and the deploy manifest entries for the target
+    """
+    report = {'target': plugin_dir, 'copied': 0, 'unchanged': 0, 'bytes': 0,
+              'seconds': 0.0, 'errors': [], 'manifest': {}}
+    identities = identities or {}
+    (copies, unchanged, errors) = plan_sync(plugin_dir, items, recorded,
+                                            identities)
+    report['unchanged'] = len(unchanged)
+    report['manifest'].update(unchanged)
+    report['errors'].extend(errors)
+
+    start = time.time()
+    results = copy_files([(source, dest) for (source, dest, target, src_stat)
+                          in copies])
+    report['seconds'] = time.time() - start
+    for (i, (dest_stat, error)) in enumerate(results):
+        (source, dest, target, src_stat) = copies[i]
+        if echo:
+            click.secho("Copying {0}".format(source), fg='magenta', nl=False)
+        if error:
+            report['errors'].append("Error copying files: {0}, {1}".format(
+                source, error))
+            if echo:
+                click.echo(click.style(' ----> ERROR', fg='red'))
+            continue
+        report['copied'] += 1
+        report['bytes'] += dest_stat.st_size
+        report['manifest'][target] = deploy_entry(
+            source, src_stat, dest_stat, identity=identities.get(source))
+        if echo:
             print ""
-            print("One or more files/directories specified in your config file\n"
-            "failed to deploy---make sure they exist or if not needed remove\n"
-            "them from the config. To ensure proper deployment, make sure your\n"
-            "UI and resource files are compiled. Using dclean to delete the\n"
-            "plugin before deploying may also help.")
+    return report
+
+
+def plan_sync(plugin_dir, items, recorded=None, identities=None):
+    """ Work out which of the (source, target) items sync_target has to
+    copy into plugin_dir. Only stats files.
+
+    :returns: a list of (source, dest, target, src_stat) to copy, the
+        deploy manifest entries of the unchanged targets and a list of
+        errors for sources that can't be read
+    """
+    recorded = recorded or {}
+    identities = identities or {}
+    copies = []
+    unchanged = {}
+    errors = []
+    for (source, target) in items:
+        dest = os.path.join(plugin_dir, target)
+        identity = identities.get(source)
+        try:
+            src_stat = os.stat(source)
+        except OSError as oops:
+            errors.append("Error copying files: {0}, {1}".format(
+                source, oops.strerror))
+            continue
+        try:
+            dest_stat = os.stat(dest)
+            entry = recorded.get(target, {})
+            if ((identity and entry.get('id') == identity and
+                 entry.get('dest') == [dest_stat.st_size, dest_stat.st_mtime]) or
+                (dest_stat.st_size == src_stat.st_size and
+                 int(dest_stat.st_mtime) == int(src_stat.st_mtime))):
+                unchanged[target] = deploy_entry(
+                    source, src_stat, dest_stat, identity)
+                continue
+        except OSError:
+            pass
+        copies.append((source, dest, target, src_stat))
+    return copies, unchanged, errors
+
+
+def copy_files(pairs, threads=COPY_THREADS):
+    """ Copy the (source, dest) file pairs, creating each destination
+    directory once up front and overlapping the copies on a thread pool.
+
+    :returns: a list of (dest_stat, error) in the order of pairs, where
+        error is None or the reason the copy failed
+    """
+    failed_dirs = {}
+    for parent in sorted(set(os.path.dirname(dest) for (source, dest) in pairs)):
+        try:
+            os.makedirs(parent)
+        except OSError as oops:
+            if oops.errno != errno.EEXIST or not os.path.isdir(parent):
+                failed_dirs[parent] = oops.strerror
+
+    def copy_pair(pair):
+        (source, dest) = pair
+        parent = os.path.dirname(dest)
+        if parent in failed_dirs:
+            return (None, failed_dirs[parent])
+        try:
+            copy_file(source, dest)
+            return (os.stat(dest), None)
+        except (IOError, OSError) as oops:
+            return (None, oops.strerror or str(oops))
+
+    if len(pairs) < 2:
+        return [copy_pair(pair) for pair in pairs]
+    pool = ThreadPool(min(threads, len(pairs)))
+    try:
+        return pool.map(copy_pair, pairs, chunksize=1)
+    finally:
+        pool.close()
+
+
+def copy_file(source, dest):
+    """ Copy the content, permissions and times of source to dest. The
+    data is moved by the kernel (copy_file_range or sendfile) where
+    available, else through a user-space buffer, into a temporary file
+    that then replaces dest. """
+    (fd, tmp) = temp_file(dest)
+    try:
+        with open(source, 'rb') as fsrc:
+            with os.fdopen(fd, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+                if copied < size:
+                    # carry on from where the kernel copy stopped
+                    fsrc.seek(copied)
+                    fdst.seek(copied)
+                    shutil.copyfileobj(fsrc, fdst, COPY_BUFFER)
+        shutil.copystat(source, tmp)
+        replace_file(tmp, dest)
+    except BaseException:
+        discard_file(tmp)
+        raise
+
+
+def kernel_copy(fd_in, fd_out, size):
+    """ Copy up to size bytes from fd_in to fd_out inside the kernel,
+    returning the number of bytes copied. Calls that aren't supported
+    (by the platform, or between the two file systems) return 0 so the
+    caller can fall back to a user-space copy. """
+    copied = 0
+    for name in ('copy_file_range', 'sendfile'):
+        call = kernel_copy_call(name)
+        if not call:
+            continue
+        while copied < size:
+            count = min(size - copied, KERNEL_COPY_CHUNK)
+            if name == 'copy_file_range':
+                done = call(fd_in, None, fd_out, None, count, 0)
+            else:
+                done = call(fd_out, fd_in, None, count)
+            if done < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOSYS, errno.EPERM):
+                    _kernel_copy[name] = None
+                if copied or err not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                         errno.EPERM, errno.EOPNOTSUPP):
+                    raise OSError(err, os.strerror(err))
+                break
+            if done == 0:
+                break
+            copied += done
+        if copied:
+            break
+    return copied
+
+
+def kernel_copy_call(name):
+    """ Return the libc copy_file_range or sendfile function, or None where
+    it isn't available """
+    if name not in _kernel_copy:
+        call = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                call = getattr(libc, name)
+                call.restype = ctypes.c_ssize_t
+                if name == 'copy_file_range':
+                    call.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                     ctypes.c_void_p, ctypes.c_size_t,
+                                     ctypes.c_uint]
+                else:
+                    call.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t]
+            except (OSError, AttributeError):
+                call = None
+        _kernel_copy[name] = call
+    return _kernel_copy[name]
+
+
+def format_rate(count, seconds):
+    """ Format a byte count and its transfer rate, e.g. 12.3 MB at 45.6 MB/s """
+    rate = count / seconds if seconds else 0
+    return "{0:.1f} MB at {1:.1f} MB/s".format(count / 1e6, rate / 1e6)
+
+
+def format_size(count):
+    """ Format a byte count for people, e.g. 12.3 MB """
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if count < 1024 or unit == 'GB':
+            break
+        count /= 1024.0
+    return "{0} {1}".format(count, unit) if unit == 'bytes' else \
+        "{0:.1f} {1}".format(count, unit)
+
+
+def file_size(path):
+    """ Return the size of path, or 0 if it doesn't exist """
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def tree_size(root):
+    """ Return the number of files below root and their total size """
+    count = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            count += 1
+            size += os.lstat(os.path.join(dirpath, fname)).st_size
+    return count, size
+
+
+def print_plan_jobs(jobs, size=None):
+    """ Print the command lines that jobs would run and, if given, the
+    size of their inputs """
+    for job in jobs:
+        click.echo("Run: {0}{1}".format(
+            ' '.join(job.cmd), ' (in {0})'.format(job.cwd) if job.cwd else ''))
+    if size is not None:
+        click.echo("{0} tool runs reading {1}".format(len(jobs), format_size(size)))
+
+
+def plan_deploy(cfg, quick=False, targets=(), bytecode=False):
+    """ Print what deploy would do: the deployments it would remove, the
+    tools it would run and the files it would copy to each target. Only
+    stats files and reads the manifests (and the git index). In hash
+    mode, files the stat index doesn't know are taken to have changed:
+    they are listed as rebuilds or copies without being read. """
+    plugin_dirs = get_deploy_targets(cfg, targets,
+                                     default=not get_stream_targets(cfg, targets))
+    if not quick:
+        for plugin_dir in plugin_dirs:
+            if os.path.isdir(plugin_dir):
+                (count, size) = tree_size(plugin_dir)
+                click.echo("Remove: {0} ({1} files, {2})".format(
+                    plugin_dir, count, format_size(size)))
+        compile_files(cfg, plan=True)
+        build_docs(plan=True)
+    items, errors = install_set(cfg)
+    identities = deploy_identities(cfg, items, cached=True)
+    manifest = read_manifest('deploy')
+    for plugin_dir in plugin_dirs:
+        if quick:
+            (copies, unchanged, problems) = plan_sync(
+                plugin_dir, items, manifest.get(os.path.abspath(plugin_dir), {}),
+                identities)
+            copies = [(target, src_stat.st_size)
+                      for (source, dest, target, src_stat) in copies]
+        else:
+            # the target is removed first, so everything is copied
+            unchanged = {}
+            problems = []
+            copies = [(target, file_size(source)) for (source, target) in items]
+        click.echo("Copy to {0}: {1} files, {2} ({3} unchanged)".format(
+            plugin_dir, len(copies), format_size(sum(size for (target, size)
+                                                     in copies)),
+            len(unchanged)))
+        for (target, size) in copies:
+            click.echo("    {0} ({1})".format(target, format_size(size)))
+        if bytecode:
+            click.echo("Byte-compile: the Python files in {0}".format(plugin_dir))
+        errors.extend(problems)
+    for (path, compression) in get_stream_targets(cfg, targets):
+        click.echo("Stream to {0}: tar{1} of {2} files, {3} uncompressed".format(
+            path, '.' + compression if compression else '', len(items),
+            format_size(sum(file_size(source) for (source, target) in items))))
+    for error in errors:
+        click.secho(error, fg='red')
+
+
+def plan_zip(cfg, plugin_dir, level=6, bytecode=False):
+    """ Print the archive zip would write from the deployed plugin and the
+    files that would go in it, without dcleaning or deploying first """
+    name = cfg.get('plugin', 'name')
+    zip_path = '{0}.zip'.format(name)
+    if not os.path.isdir(plugin_dir):
+        click.secho("{0} is not deployed---use pb_tool deploy first".format(
+            plugin_dir), fg='red')
+        return
+    if bytecode:
+        click.echo("Byte-compile: the Python files in {0}".format(plugin_dir))
+    excluded = package_filter(cfg, bytecode)
+    inputs = package_identities(cfg, plugin_dir, level, excluded, cached=True)
+    current = package_entry(zip_path, inputs) if inputs else None
+    if current and read_manifest('package').get(zip_path) == current:
+        click.echo("{0} is up to date".format(zip_path))
+        return
+    members = []
+    for dirpath, dirnames, filenames in filtered_walk(plugin_dir, excluded):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            members.append((os.path.relpath(path, plugin_dir),
+                            os.path.getsize(path)))
+    members.sort()
+    click.echo("Write: {0} from {1}: {2} files, {3} (level {4})".format(
+        zip_path, plugin_dir, len(members),
+        format_size(sum(size for (rel, size) in members)), level))
+    for (rel, size) in members:
+        click.echo("    {0} ({1})".format(rel, format_size(size)))
 
 
-def clean_deployment(ask_first=True, config='pb_tool.cfg'):
+def deploy_entry(source, src_stat, dest_stat, identity=None):
+    """ Return the deploy manifest entry for a deployed file """
+    return {'source': source,
+            'stat': [src_stat.st_size, src_stat.st_mtime],
+            'dest': [dest_stat.st_size, dest_stat.st_mtime],
+            'id': identity}
+
+
+def deploy_identities(cfg, items, cached=False):
+    """ Return the content identities of the install set sources, or an
+    empty dict when change detection is by modification time. cached is
+    as for hash_files. """
+    mode = change_detection(cfg)
+    if mode == 'mtime':
+        return {}
+    return file_identities([source for (source, target) in items], mode,
+                           cached)
+
+
+def record_deployment(reports):
+    """ Save the deploy manifest entries of the sync reports, keyed by
+    target directory """
+    with locked(lock_path('deploy')):
+        manifest = read_manifest('deploy')
+        for report in reports:
+            manifest[os.path.abspath(report['target'])] = report['manifest']
+        write_manifest(manifest, 'deploy')
+
+
+def report_errors(errors):
+    if errors:
+        print "\nERRORS:"
+        for error in errors:
+            print error
+        print ""
+        print("One or more files/directories specified in your config file\n"
+        "failed to deploy---make sure they exist or if not needed remove\n"
+        "them from the config. To ensure proper deployment, make sure your\n"
+        "UI and resource files are compiled. Using dclean to delete the\n"
+        "plugin before deploying may also help.")
+
+
+def reload_enabled(cfg):
+    """ Return True if the config asks for the plugin to be reloaded in
+    QGIS after each deploy (reload in the [deploy] section) """
+    return cfg_get(cfg, 'deploy', 'reload').strip().lower() in (
+        '1', 'yes', 'true', 'on')
+
+
+def reload_port(cfg):
+    """ Return the port of the reload listener in QGIS """
+    port = cfg_get(cfg, 'deploy', 'reload_port').strip()
+    return int(port) if port else RELOAD_PORT
+
+
+def notify_reload(name, port=RELOAD_PORT, timeout=5.0):
+    """ Send a reload request for the plugin name to a listener on the
+    local port and wait for the reply.
+
+    :returns: the reply of the listener ('ok' or 'error <reason>'), or
+        None if no listener is running
+    """
+    try:
+        conn = socket.create_connection(('127.0.0.1', port), timeout)
+    except socket.error:
+        return None
+    try:
+        conn.sendall('reload {0}\n'.format(name))
+        reply = conn.makefile().readline().strip()
+    except socket.error as oops:
+        reply = 'error {0}'.format(oops)
+    finally:
+        conn.close()
+    return reply or 'error no reply from the listener'
+
+
+def report_reload(cfg):
+    """ Ask QGIS to reload the plugin and print the outcome.
+
+    :returns: True if the plugin was reloaded
+    """
+    name = cfg.get('plugin', 'name')
+    port = reload_port(cfg)
+    start = time.time()
+    reply = notify_reload(name, port)
+    if reply is None:
+        click.secho("QGIS isn't listening for reload requests on port {0}---"
+                    "see pb_tool listener --help".format(port), fg='yellow')
+        return False
+    if reply != 'ok':
+        click.secho("QGIS couldn't reload {0}: {1}".format(
+            name, reply.partition(' ')[2] or reply), fg='red')
+        return False
+    click.secho("Reloaded {0} in QGIS ({1:.2f}s)".format(
+        name, time.time() - start), fg='green')
+    return True
+
+
+class StandInListener(object):
+    """ Accepts reload requests like the listener pb_tool installs in
+    QGIS, recording the requested plugin names instead of reloading them.
+    Used by tests, and to watch requests without QGIS. """
+
+    class Handler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            (command, space, name) = self.rfile.readline().strip().partition(' ')
+            if command != 'reload' or not name:
+                self.wfile.write('error unknown request\n')
+                return
+            self.server.listener.requests.append(name)
+            if self.server.listener.echo:
+                click.echo("Reload requested for {0}".format(name))
+            self.wfile.write('ok\n')
+
+    class Server(SocketServer.TCPServer):
+        allow_reuse_address = True
+
+    def __init__(self, port=0, echo=False):
+        self.requests = []
+        self.echo = echo
+        self.server = self.Server(('127.0.0.1', port), self.Handler)
+        self.server.listener = self
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        """ Serve requests on a background thread """
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def clean_deployment(ask_first=True, config='pb_tool.cfg', plugin_dir=None):
     """ Remove the deployed plugin from the .qgis2/python/plugins directory
     """
-    name = get_config(config).get('plugin', 'name')
-    plugin_dir = os.path.join(get_plugin_directory(), name)
+    if not plugin_dir:
+        name = get_config(config).get('plugin', 'name')
+        plugin_dir = os.path.join(get_plugin_directory(), name)
     if ask_first:
         proceed = click.confirm('Delete the deployed plugin from {0}?'.format(plugin_dir))
     else:
@@ -182,7 +1115,12 @@ def clean_deployment(ask_first=True, config='pb_tool.cfg'):
     if proceed:
         click.echo('Removing plugin from {0}'.format(plugin_dir))
         try:
-            shutil.rmtree(plugin_dir)
+            with locked(target_lock(plugin_dir), lock_path('deploy')):
+                collect_trash([plugin_dir])
+                remove_tree(plugin_dir)
+                manifest = read_manifest('deploy')
+                if manifest.pop(os.path.abspath(plugin_dir), None) is not None:
+                    write_manifest(manifest, 'deploy')
             return True
         except OSError as oops:
             print 'Plugin was not deleted: {0}'.format(oops.strerror)
@@ -191,6 +1129,75 @@ def clean_deployment(ask_first=True, config='pb_tool.cfg'):
     return False
 
 
+def remove_tree(path):
+    """ Remove the directory tree at path without waiting for it to be
+    deleted. The tree is renamed into a temporary directory beside its
+    parent (so path is free at once, the rename normally stays on one
+    file system and QGIS doesn't take the trash for a plugin), which a
+    detached process deletes. Falls back to deleting in place if the tree
+    can't be renamed. """
+    trash = None
+    try:
+        trash = tempfile.mkdtemp(prefix=TRASH_PREFIX, dir=trash_parent(path))
+        os.rename(path, os.path.join(trash, os.path.basename(path)))
+    except OSError as oops:
+        if trash:
+            os.rmdir(trash)
+        if oops.errno == errno.ENOENT and not os.path.lexists(path):
+            raise
+        shutil.rmtree(path)
+        return
+    delete_trees([trash])
+
+
+def delete_trees(paths):
+    """ Delete the directory trees in a detached process, or in background
+    threads if a process can't be started """
+    if not paths:
+        return
+    script = ('import shutil, sys\n'
+              'for path in sys.argv[1:]:\n'
+              '    shutil.rmtree(path, True)\n')
+    try:
+        if os.name == 'nt':
+            # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+            subprocess.Popen([sys.executable, '-c', script] + paths,
+                             creationflags=0x00000008 | 0x00000200,
+                             close_fds=True)
+        else:
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.Popen([sys.executable, '-c', script] + paths,
+                                 stdin=devnull, stdout=devnull, stderr=devnull,
+                                 close_fds=True, preexec_fn=os.setsid)
+    except OSError:
+        for path in paths:
+            thread = threading.Thread(target=shutil.rmtree, args=(path, True))
+            thread.start()
+
+
+def trash_parent(path):
+    """ Return the directory the trash of path goes in: the parent of the
+    directory holding path """
+    return os.path.dirname(os.path.dirname(os.path.abspath(path)))
+
+
+def collect_trash(plugin_dirs):
+    """ Delete trash directories left over from earlier removals (for
+    instance when the deleting process was killed) beside the plugins
+    directories, or in them where older versions put it """
+    parents = set()
+    for plugin_dir in plugin_dirs:
+        parents.add(trash_parent(plugin_dir))
+        parents.add(os.path.dirname(os.path.abspath(plugin_dir)))
+    for parent in parents:
+        try:
+            names = os.listdir(parent)
+        except OSError:
+            continue
+        delete_trees([os.path.join(parent, name) for name in names
+                      if name.startswith(TRASH_PREFIX)])
+
+
 @cli.command()
 def clean_docs():
     """
@@ -202,10 +1209,7 @@ def clean_docs():
             makeprg = 'make.bat'
         else:
             makeprg = 'make'
-        cwd = os.getcwd()
-        os.chdir('help')
-        subprocess.check_call([makeprg, 'clean'])
-        os.chdir(cwd)
+        run_tool(Job('make clean', [makeprg, 'clean'], cwd='help'))
     else:
         print "No help directory exists in the current directory"
 
@@ -213,10 +1217,14 @@ def clean_docs():
 @cli.command()
 @click.option('--config', default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def dclean(config):
+@click.option('--target', '-t', multiple=True,
+              help='Plugin directory to clean (may be repeated). Overrides \
+              the targets in the [deploy] section of the config')
+def dclean(config, target):
     """ Remove the deployed plugin from the .qgis2/python/plugins directory
     """
-    clean_deployment(True, config)
+    for plugin_dir in get_deploy_targets(get_config(config), target):
+        clean_deployment(True, config, plugin_dir)
 
 
 @cli.command()
@@ -228,22 +1236,205 @@ def clean(config):
     cfg = get_config(config)
     files = compiled_ui(cfg) + compiled_resource(cfg)
     click.echo('Cleaning resource and ui files')
-    for file in files:
+
+    def unlink(file):
         try:
             os.unlink(file)
-            print "Deleted: {0}".format(file)
+            return None
         except OSError as oops:
-            print "Couldn't delete {0}: {1}".format(file, oops.strerror)
+            return oops.strerror
+
+    if files:
+        pool = ThreadPool(min(COPY_THREADS, len(files)))
+        try:
+            results = pool.map(unlink, files)
+        finally:
+            pool.close()
+        for (i, error) in enumerate(results):
+            if error:
+                print "Couldn't delete {0}: {1}".format(files[i], error)
+            else:
+                print "Deleted: {0}".format(files[i])
 
 
 @cli.command()
 @click.option('--config', default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def compile(config):
+@click.option('--plan', is_flag=True,
+              help='Print the tools that would run without running them')
+def compile(config, plan):
     """
     Compile the resource and ui files
     """
-    compile_files(get_config(config))
+    compile_files(get_config(config), plan)
+
+
+@cli.command('batch-compile')
+@click.argument('projects', nargs=-1,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file in each project if other than pb_tool.cfg')
+@click.option('--jobs', '-j', default=0, type=int,
+              help='Number of worker processes (default: number of CPUs)')
+def batch_compile(projects, config, jobs):
+    """ Compile the UI and resource files of several plugins at once.
+    PROJECTS are plugin directories; by default every directory below the
+    current one with a config file is compiled. """
+    projects = projects or find_projects('.', config)
+    if not projects:
+        print "No {0} files found below the current directory".format(config)
+        return
+    start = time.time()
+    results = batch_compile_projects(projects, config, jobs)
+    total = 0
+    failed = False
+    for result in results:
+        click.secho(result['project'], bold=True)
+        for (message, fg) in result['notes']:
+            click.secho("    {0}".format(message), fg=fg)
+        report_jobs(result['jobs'])
+        errors = len([job for job in result['jobs'] if job.status != 'ok'])
+        failed = failed or errors or result['error']
+        total += result['compiled']['UI'] + result['compiled']['resource']
+        click.secho("    Compiled {0} UI and {1} resource files, {2} failed".format(
+            result['compiled']['UI'], result['compiled']['resource'], errors),
+            fg='red' if errors else 'green')
+    click.secho("Compiled {0} files in {1} projects in {2:.1f}s".format(
+        total, len(results), time.time() - start), fg='green')
+    if failed:
+        sys.exit(1)
+
+
+def find_projects(root='.', config='pb_tool.cfg'):
+    """ Return the directories below root that have a config file, without
+    looking inside them or in hidden and build directories """
+    projects = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if config in filenames:
+            projects.append(os.path.normpath(dirpath))
+            dirnames[:] = []
+            continue
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and
+                             d not in ('build', '__pycache__'))
+    return projects
+
+
+def batch_compile_projects(projects, config='pb_tool.cfg', jobs=0):
+    """ Compile the out of date UI and resource files of several projects
+    in one pool of worker processes. Each worker loads the UI compiler
+    once (see init_compile_worker) and compiles resource files itself or
+    runs the resource compiler tool.
+
+    :returns: a result dict for each project, with the project directory,
+        notes about skipped files as (message, colour) pairs, the jobs
+        run, the number of UI and resource files compiled and an error
+        message (or None) if the project couldn't be read
+    """
+    home = os.getcwd()
+    results = []
+    # (result, cfg, built, pending) for each project
+    projects_pending = []
+    work = []
+    locks = [os.path.join(home, project, lock_path('compile'))
+             for project in projects
+             if os.path.exists(os.path.join(home, project, config))]
+    with locked(*locks):
+        try:
+            for project in projects:
+                result = {'project': project, 'notes': [], 'jobs': [],
+                          'compiled': {'UI': 0, 'resource': 0}, 'error': None}
+                results.append(result)
+                os.chdir(os.path.join(home, project))
+                if not os.path.exists(config):
+                    result['error'] = "There is no {0} file".format(config)
+                    result['notes'].append((result['error'], 'red'))
+                    continue
+                cfg = get_config(config)
+                built = read_manifest('compile')
+                pending = compile_tasks(
+                    cfg, built, lambda message, fg=None, notes=result['notes']:
+                    notes.append((message, fg)))
+                result['jobs'] = [job for (job, output, inputs, kind)
+                                  in pending]
+                for (job, output, inputs, kind) in pending:
+                    work.append((len(work), job.cmd, os.getcwd(), kind,
+                                 job.name, partial_path(output)))
+                projects_pending.append((result, cfg, built, pending))
+
+            all_jobs = [job for project_pending in projects_pending
+                        for job in project_pending[0]['jobs']]
+            if work:
+                pool = Pool(min(jobs or cpu_count(), len(work)),
+                            init_compile_worker)
+                try:
+                    for (index, ok, output, seconds) in pool.imap_unordered(
+                            compile_worker, work):
+                        job = all_jobs[index]
+                        job.status = 'ok' if ok else 'failed'
+                        job.returncode = 0 if ok else 1
+                        job.output = output
+                        job.duration = seconds
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for (result, cfg, built, pending) in projects_pending:
+                os.chdir(os.path.join(home, result['project']))
+                result['compiled'] = record_compiled(cfg, pending, built)
+                write_manifest(built, 'compile')
+        finally:
+            os.chdir(home)
+    return results
+
+
+# PyQt4.uic, when a batch compile worker could load it
+_uic = []
+
+
+def init_compile_worker():
+    """ Load the UI compiler in a batch compile worker process """
+    try:
+        from PyQt4 import uic
+        _uic.append(uic)
+    except ImportError:
+        pass
+
+
+def compile_worker(task):
+    """ Compile one file for batch_compile_projects in a worker process.
+    UI files are compiled with the loaded UI compiler and resource files
+    with the built-in compiler (unless the project uses the tools); other
+    files, or all UI files if PyQt4 isn't importable, by running the tool.
+
+    :returns: (index, ok, output, seconds)
+    """
+    (index, cmd, cwd, kind, source, output) = task
+    start = time.time()
+    if cmd[0] == BUILTIN_RCC:
+        try:
+            os.chdir(cwd)
+            return (index, True, compile_qrc(source, output, '-binary' in cmd),
+                    time.time() - start)
+        except (EnvironmentError, SyntaxError, ValueError) as oops:
+            return (index, False, '{0}: {1}'.format(source, oops),
+                    time.time() - start)
+    if kind == 'UI' and _uic:
+        try:
+            with open(os.path.join(cwd, source)) as ui_file:
+                with open(os.path.join(cwd, output), 'w') as py_file:
+                    _uic[0].compileUi(ui_file, py_file)
+            return (index, True, '', time.time() - start)
+        except Exception as oops:
+            return (index, False, '{0}: {1}'.format(source, oops),
+                    time.time() - start)
+    try:
+        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        text = process.communicate()[0]
+        return (index, process.returncode == 0, text, time.time() - start)
+    except OSError as oops:
+        return (index, False, '{0}: {1}'.format(cmd[0], oops.strerror),
+                time.time() - start)
 
 
 @cli.command()
@@ -252,18 +1443,21 @@ def doc():
     build_docs()
 
 
-def build_docs():
+def build_docs(plan=False):
     """ Build the docs using sphinx"""
     if os.path.exists('help'):
-        click.echo('Building the help documentation')
         if sys.platform == 'win32':
             makeprg = 'make.bat'
         else:
             makeprg = 'make'
-        cwd = os.getcwd()
-        os.chdir('help')
-        subprocess.check_call([makeprg, 'html'])
-        os.chdir(cwd)
+        job = Job('make html', [makeprg, 'html'], cwd='help')
+        if plan:
+            print_plan_jobs([job])
+            return
+        click.echo('Building the help documentation')
+        start = time.time()
+        run_tool(job)
+        record_step('docs', time.time() - start)
     else:
         print "No help directory exists in the current directory"
 
@@ -271,10 +1465,70 @@ def build_docs():
 @cli.command()
 @click.option('--config', default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def translate(config):
-    """ Build translations using lrelease. Locales must be specified
-    in the config file and the corresponding .ts file must exist in
-    the i18n directory of your plugin."""
+@click.option('--plan', is_flag=True,
+              help='Print the translations that would be compiled '
+              'without compiling them')
+@click.option('--lrelease', 'use_lrelease', is_flag=True,
+              help='Compile with lrelease instead of the built-in compiler')
+def translate(config, plan, use_lrelease):
+    """ Compile the .ts translation files to .qm files. Locales must be
+    specified in the config file and the corresponding .ts file must
+    exist in the i18n directory of your plugin. The built-in compiler is
+    used unless --lrelease is given or lrelease is set in the [build]
+    section of the config."""
+    cfg = get_config(config)
+    if not check_cfg(cfg, 'files', 'locales'):
+        return
+    locales = cfg.get('files', 'locales').split()
+    if not locales:
+        print "No translations are specified in {0}".format(config)
+        return
+    ts_files = []
+    for locale in locales:
+        (name, ext) = os.path.splitext(locale)
+        if ext != '.ts':
+            print 'no ts extension'
+            locale = name + '.ts'
+        ts_files.append(os.path.join('i18n', locale))
+    if use_lrelease or cfg_get(cfg, 'build', 'lrelease').strip().lower() in (
+            '1', 'yes', 'true', 'on'):
+        translate_lrelease(cfg, ts_files, plan)
+        return
+
+    pending = []
+    for ts in ts_files:
+        qm = os.path.splitext(ts)[0] + '.qm'
+        if not os.path.exists(ts):
+            print "{0} does not exist---skipped".format(ts)
+        elif file_changed(ts, qm):
+            pending.append((ts, qm))
+        else:
+            print "Skipping {0} (unchanged)".format(ts)
+    if plan:
+        for (ts, qm) in pending:
+            click.echo("Compile: {0} to {1}".format(ts, qm))
+        click.echo("{0} translations reading {1}".format(
+            len(pending), format_size(sum(file_size(ts) for (ts, qm) in pending))))
+        return
+    start = time.time()
+    failed = False
+    with locked(lock_path('translate')):
+        results = compile_translations(pending)
+    for (ts, qm, count, error) in results:
+        if error:
+            click.secho("Couldn't compile {0}: {1}".format(ts, error), fg='red')
+            failed = True
+        else:
+            print "Compiled {0} to {1} ({2} messages)".format(ts, qm, count)
+    record_step('translate', time.time() - start, len(ts_files),
+                sum(file_size(ts) for (ts, qm) in pending),
+                len(ts_files) - len(pending), len(pending))
+    if failed:
+        sys.exit(1)
+
+
+def translate_lrelease(cfg, ts_files, plan=False):
+    """ Compile the .ts files with lrelease, one process per locale """
     possibles = ['lrelease', 'lrelease-qt4']
     for binary in possibles:
         cmd = check_path(binary)
@@ -287,64 +1541,151 @@ def translate(config):
             print ('You can get lrelease by installing'
                    ' the qt4-devel package in the Libs'
                    '\nsection of the OSGeo4W Advanced Install.')
+        return
+    configure_jobs(cfg)
+    jobs = []
+    for ts in ts_files:
+        if not plan:
+            print cmd, os.path.basename(ts)
+        qm = os.path.splitext(ts)[0] + '.qm'
+        jobs.append(Job(os.path.basename(ts), [cmd, ts, '-qm', partial_path(qm)],
+                        timeout=tool_timeout(cfg)))
+    if plan:
+        print_plan_jobs(jobs, sum(file_size(job.cmd[1]) for job in jobs))
     else:
-        cfg = get_config(config)
-        if check_cfg(cfg, 'files', 'locales'):
-            locales = cfg.get('files', 'locales').split()
-            if locales:
-                for locale in locales:
-                    (name, ext) = os.path.splitext(locale)
-                    if ext != '.ts':
-                        print 'no ts extension'
-                        locale = name + '.ts'
-                    print cmd, locale
-                    subprocess.check_call([cmd, os.path.join('i18n', locale)])
-            else:
-                print "No translations are specified in {0}".format(config)
+        start = time.time()
+        with locked(lock_path('translate')):
+            ok = run_jobs(jobs)
+            for job in jobs:
+                qm = job.cmd[-1]
+                if job.status == 'ok' and os.path.exists(qm):
+                    replace_file(qm, qm[:-len('.part')])
+                else:
+                    discard_file(qm)
+        record_step('translate', time.time() - start, len(jobs),
+                    sum(file_size(job.cmd[1]) for job in jobs))
+        report_jobs(jobs)
+        if not ok:
+            sys.exit(1)
+
+
+@cli.command('update-strings')
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+def update_strings(config):
+    """ Extract translatable strings from the Python and UI files of the
+    plugin into the .ts file of each locale. Strings are cached per source
+    file by content hash, so only changed files are parsed again, and every
+    .ts file is merged in one pass, keeping existing translations."""
+    cfg = get_config(config)
+    locales = cfg_get(cfg, 'files', 'locales').split()
+    if not locales:
+        print "No translations are specified in {0}".format(config)
+        return
+    with locked(lock_path('strings')):
+        update_ts_files(cfg, locales)
+
+
+def update_ts_files(cfg, locales):
+    """ Extract the strings of the plugin and merge them into the .ts file
+    of each locale """
+    sources = translatable_sources(cfg)
+    mode = 'git' if change_detection(cfg) == 'git' else 'hash'
+    identities = file_identities(sources, mode)
+    cache = read_manifest('strings')
+    extracted = {}
+    parsed = 0
+    for path in sources:
+        entry = cache.get(path)
+        if not entry or entry['id'] != identities[path]:
+            entry = {'id': identities[path], 'messages': extract_strings(path)}
+            parsed += 1
+        extracted[path] = entry
+    write_manifest(extracted, 'strings')
+    click.echo("Extracted strings from {0} of {1} files".format(
+        parsed, len(sources)))
+
+    messages = [(path, message) for path in sources
+                for message in extracted[path]['messages']]
+    for locale in locales:
+        (name, ext) = os.path.splitext(locale)
+        ts_file = os.path.join('i18n', name + '.ts')
+        if merge_ts(ts_file, name, messages):
+            click.secho("Updated {0}".format(ts_file), fg='green')
+        else:
+            click.echo("{0} is up to date".format(ts_file))
 
 
 @cli.command()
 @click.option('--config', default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def zip(config):
+@click.option('--level', '-l', default=6, type=click.IntRange(0, 9),
+              help='Compression level from 0 (store) to 9 (best), default 6')
+@click.option('--jobs', '-j', default=0, type=int,
+              help='Number of compression threads (default: number of CPUs)')
+@click.option('--bytecode', '-b', is_flag=True,
+              help='Byte-compile the deployed Python files before packaging')
+@click.option('--plan', is_flag=True,
+              help='Print what would be packaged without creating the zip')
+@click.option('--check/--no-check', default=None,
+              help='Run pb_tool check first and stop if it finds problems \
+              (default: the gate option in the [check] section of the config)')
+def zip(config, level, jobs, bytecode, plan, check):
     """ Package the plugin into a zip file
     suitable for uploading to the QGIS
     plugin repository"""
 
-    # check to see if we can find zip or 7z
-    zip = check_path('zip')
-    if not zip:
-        # check for 7z
-        zip = check_path('7z')
-        if not zip:
-            click.secho('zip or 7z not found. Unable to package the plugin',
-                    fg='red')
-            click.secho('Check your path or install a zip program', fg='red')
-            return
-    click.secho('Found zip: %s' % zip, fg='green')
-
-    name = get_config(config).get('plugin', 'name', None)
+    cfg = get_config(config)
+    name = cfg.get('plugin', 'name', None)
+    # package the deployment in the first deploy target
+    plugin_dir = get_deploy_targets(cfg)[0]
+    if plan:
+        plan_zip(cfg, plugin_dir, level, bytecode)
+        return
+    if not check_gate(cfg, check):
+        sys.exit(1)
     confirm = click.confirm('Do a dclean and deploy first?')
     if confirm:
-        clean_deployment(False, config)
-        deploy_files(config)
+        # only the target that is packaged is cleaned and deployed to
+        clean_deployment(False, config, plugin_dir)
+        deploy_files(config, targets=[os.path.dirname(plugin_dir)],
+                     bytecode=bytecode, check=False)
+    elif bytecode:
+        compile_bytecode(plugin_dir)
 
     confirm = click.confirm(
         'Create a packaged plugin ({0}.zip) from the deployed files?'.format(name))
     if confirm:
-        # delete the zip if it exists
-        if os.path.exists('{0}.zip'.format(name)):
-            os.unlink('{0}.zip'.format(name))
-        if name:
-            cwd = os.getcwd()
-            os.chdir(get_plugin_directory())
-            subprocess.check_call([zip, '-r',
-                                   os.path.join(cwd, '{0}.zip'.format(name)),
-                                   name])
-
-            print ('The {0}.zip archive has been created in the current directory'.format(name))
-        else:
-            click.echo("Your config file is missing the plugin name (name=parameter)")
+        if not os.path.isdir(plugin_dir):
+            click.secho("{0} is not deployed---use pb_tool deploy first".format(
+                plugin_dir), fg='red')
+            return
+        zip_path = '{0}.zip'.format(name)
+        with locked(lock_path('package'), target_lock(plugin_dir)):
+            start = time.time()
+            packages = read_manifest('package')
+            excluded = package_filter(cfg, bytecode)
+            inputs = package_identities(cfg, plugin_dir, level, excluded)
+            current = package_entry(zip_path, inputs) if inputs else None
+            if current and packages.get(zip_path) == current:
+                click.secho("{0} is up to date".format(zip_path), fg='green')
+                record_step('package', time.time() - start, hits=1)
+                return
+            if name:
+                (count, size, compressed) = write_archive(
+                    zip_path, plugin_dir, name, level, jobs or cpu_count(),
+                    excluded)
+                click.secho("Added {0} files, {1} bytes compressed to {2} bytes".format(
+                    count, size, compressed), fg='green')
+                record_step('package', time.time() - start, count, size,
+                            misses=1)
+                if inputs:
+                    packages[zip_path] = package_entry(zip_path, inputs)
+                    write_manifest(packages, 'package')
+
+                print ('The {0}.zip archive has been created in the current directory'.format(name))
+            else:
+                click.echo("Your config file is missing the plugin name (name=parameter)")
 
 
 @cli.command()
@@ -371,36 +1712,338 @@ def validate(config):
     if not check_cfg(cfg, 'help', 'target'):
         valid = False
 
+    problems, warnings = check_files(cfg)
+    for warning in warnings:
+        click.secho("Warning: {0}".format(warning), fg='yellow')
+    for problem in problems:
+        click.secho(problem, fg='red')
+    if problems:
+        valid = False
+
     if valid:
         click.secho("Your {0} file is valid and contains all mandatory items".format(config), fg='green')
     else:
         click.secho("Your {0} file is invalid".format(config), fg='red')
+        sys.exit(1)
 
 
 @cli.command()
 @click.option('--config', default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def list(config):
-    """ List the contents of the configuration file """
-    if os.path.exists(config):
-        with open(config) as cfg:
-            for line in cfg:
-                print line[:-1]
+@click.option('--all', 'run_all', is_flag=True,
+              help='Run the full test suite instead of only the affected tests')
+@click.option('--since', default=None,
+              help='Select tests affected by files changed since this git \
+              revision (e.g. HEAD) instead of since the last passing run')
+def test(config, run_all, since):
+    """ Run the tests affected by changed files. The import graph of the
+    plugin and its tests is cached in the build manifest and only tests
+    that import a changed file (directly or transitively) are run."""
+    cfg = get_config(config)
+    test_dir = cfg_get(cfg, 'test', 'dir', 'test')
+    # the lock is held while the manifest is updated, not while tests run
+    with locked(lock_path('manifest')):
+        manifest = read_manifest()
+        graph, hashes = import_graph(cfg, manifest)
+        write_manifest(manifest)
+    tests = sorted(path for path in graph
+                   if path.startswith(test_dir + os.sep) and
+                   os.path.basename(path).startswith('test_'))
+    if not tests:
+        click.secho("No tests found in {0}".format(test_dir), fg='red')
+        return
+
+    if run_all:
+        selected = tests
     else:
-        click.secho("There is no {0} file in the current directory".format(config), fg='red')
-        click.secho("We can't do anything without it", fg='red')
+        if since:
+            changed = git_changed_files(since)
+            if changed is None:
+                click.secho("Unable to get the changes since {0} from git".format(
+                    since), fg='red')
+                return
+        else:
+            tested = manifest.get('tested', {})
+            changed = set(path for path in hashes
+                          if tested.get(path) != hashes[path])
+        affected = dependents(graph, changed)
+        selected = [path for path in tests if path in affected]
 
+    click.secho("Running {0} of {1} test modules".format(
+        len(selected), len(tests)), fg='green')
+    if selected:
+        if run_tests(selected) != 0:
+            click.secho("Tests failed", fg='red')
+            sys.exit(1)
+    with locked(lock_path('manifest')):
+        manifest = read_manifest()
+        manifest.setdefault('tested', {}).update(hashes)
+        write_manifest(manifest)
 
-@cli.command()
-@click.option('--name', default='pb_tool.cfg',
-              help='Name of the config file to create if other than pb_tool.cfg')
-def create(name):
-    """
-    Create a config file based on source files in the current directory
-    """
-    template = Template(config_template())
-    # guess the plugin name
-    try:
+
+@cli.command('profile-load')
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--target', '-t', default=None,
+              help='Plugin directory to profile if other than the first deploy \
+              target')
+@click.option('--min-ms', default=1.0,
+              help='Hide imports that took less than this many milliseconds')
+@click.option('--limit', default=15,
+              help='Number of modules to list in the slowest module ranking')
+def profile_load(config, target, min_ms, limit):
+    """ Profile loading the deployed plugin. The plugin is imported and
+    its classFactory and initGui are called with the stub QgisInterface
+    from the plugin's test directory (or a minimal stand-in when QGIS
+    isn't available), recording the time and memory of each import."""
+    cfg = get_config(config)
+    plugin_dir = get_deploy_targets(cfg, [target] if target else ())[0]
+    if not os.path.isdir(plugin_dir):
+        click.secho("{0} is not deployed---use pb_tool deploy first".format(
+            plugin_dir), fg='red')
+        sys.exit(1)
+    iface, kind = load_iface(cfg_get(cfg, 'test', 'dir', 'test'))
+    click.secho("Profiling {0} with the {1}".format(plugin_dir, kind), fg='green')
+
+    sys.path.insert(0, os.path.dirname(plugin_dir))
+    package = os.path.basename(plugin_dir)
+    phases = [
+        ('import {0}'.format(package),
+         lambda results: __import__(package)),
+        ('classFactory(iface)',
+         lambda results: results['import {0}'.format(package)].classFactory(iface)),
+        ('initGui()',
+         lambda results: results['classFactory(iface)'].initGui())]
+    roots = profile_imports(phases)
+
+    click.echo("\n     Time    Memory  Import tree")
+    for root in roots:
+        print_import_node(root, 0, min_ms / 1000.0)
+        if 'error' in root:
+            click.secho("    {0} failed: {1}".format(root['name'], root['error']),
+                        fg='red')
+    click.echo("\nSlowest modules (excluding their imports):")
+    ranked = sorted(flatten_imports(roots), key=lambda node: node['self'],
+                    reverse=True)
+    for node in ranked[:limit]:
+        click.echo("{0:9.1f} ms  {1}".format(node['self'] * 1000, node['name']))
+    if any('error' in root for root in roots):
+        sys.exit(1)
+
+
+@cli.command('reload')
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+def reload_plugin(config):
+    """ Ask a running QGIS to reload the deployed plugin. QGIS must be
+    running the listener installed by the listener command. """
+    if not report_reload(get_config(config)):
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--port', default=None, type=int,
+              help='Port to listen on (default: reload_port in the [deploy] \
+              section of the config, or {0})'.format(RELOAD_PORT))
+@click.option('--stand-in', is_flag=True,
+              help='Run a stand-in listener that prints the reload requests \
+              it gets instead of installing the QGIS listener')
+def listener(config, port, stand_in):
+    """ Install the listener that lets deploy --reload and the reload
+    command reload plugins in QGIS. It is started from the startup.py of
+    your QGIS Python directory. """
+    cfg = get_config(config) if os.path.exists(config) else None
+    port = port or (reload_port(cfg) if cfg else RELOAD_PORT)
+    if stand_in:
+        server = StandInListener(port, echo=True)
+        click.secho("Listening for reload requests on port {0} (Ctrl-C to stop)".format(
+            server.port), fg='green')
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server.server_close()
+        return
+    python_dir = os.path.dirname(get_plugin_directory())
+    if not os.path.isdir(python_dir):
+        os.makedirs(python_dir)
+    module = os.path.join(python_dir, 'pb_tool_listener.py')
+    with atomic_write(module, 'w') as f:
+        f.write(Template(listener_template()).substitute(Port=port))
+    startup = os.path.join(python_dir, 'startup.py')
+    try:
+        with open(startup) as f:
+            installed = 'import pb_tool_listener' in f.read()
+    except IOError:
+        installed = False
+    if not installed:
+        with open(startup, 'a') as f:
+            f.write('\n# reload plugins deployed by pb_tool\nimport pb_tool_listener\n')
+    click.secho("Installed {0}, started from {1}. Restart QGIS to start "
+                "listening on port {2}.".format(module, startup, port), fg='green')
+
+
+@cli.command()
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--jobs', '-j', default=0, type=int,
+              help='Number of worker processes (default: number of CPUs)')
+def check(config, jobs):
+    """ Check the Python files of the plugin with pyflakes and pep8.
+    Results are cached by file content, so only changed files are checked
+    again. """
+    cfg = get_config(config)
+    if not print_checks(cfg, jobs):
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--command', '-c', default=None,
+              help='Only show runs of this command')
+@click.option('--runs', '-n', default=100,
+              help='Number of most recent runs to analyse')
+@click.option('--baseline', default=10,
+              help='Number of runs before the last one the last run is \
+              compared with')
+@click.option('--threshold', default=1.5,
+              help='How many times slower than the baseline median a step \
+              has to be to count as a regression')
+def stats(command, runs, baseline, threshold):
+    """ Show build timing history: percentiles of command and step times,
+    cache hit rates, file and byte counts, the slowest steps and steps
+    that got slower than their recent baseline."""
+    history = read_metrics(command, runs)
+    if not history:
+        print "No metrics have been recorded in {0}".format(
+            os.path.join(MANIFEST_DIR, METRICS_DB))
+        return
+    totals = {}
+    steps = {}
+    for run in history:
+        totals.setdefault(run['command'], []).append(run['seconds'])
+        for step in run['steps']:
+            steps.setdefault((run['command'], step['name']), []).append(step)
+
+    click.secho("{0:<30} {1:>5} {2:>8} {3:>8} {4:>8} {5:>8}".format(
+        'Command', 'Runs', 'p50', 'p90', 'max', 'last'), bold=True)
+    for name in sorted(totals):
+        times = totals[name]
+        click.echo("{0:<30} {1:>5} {2:>7.2f}s {3:>7.2f}s {4:>7.2f}s {5:>7.2f}s".format(
+            name, len(times), percentile(times, 50), percentile(times, 90),
+            max(times), times[-1]))
+
+    click.secho("\n{0:<30} {1:>5} {2:>8} {3:>8} {4:>8} {5:>7} {6:>10}".format(
+        'Step', 'Runs', 'p50', 'p90', 'max', 'hits', 'size'), bold=True)
+    for key in sorted(steps):
+        times = [step['seconds'] for step in steps[key]]
+        hits = sum(step['hits'] for step in steps[key])
+        lookups = hits + sum(step['misses'] for step in steps[key])
+        click.echo("{0:<30} {1:>5} {2:>7.2f}s {3:>7.2f}s {4:>7.2f}s {5:>7} {6:>10}".format(
+            '/'.join(key), len(times), percentile(times, 50),
+            percentile(times, 90), max(times),
+            '{0:.0%}'.format(float(hits) / lookups) if lookups else '-',
+            format_size(steps[key][-1]['bytes'])))
+
+    slowest = sorted(steps, key=lambda key: percentile(
+        [step['seconds'] for step in steps[key]], 90), reverse=True)[:5]
+    click.secho("\nSlowest steps (p90): {0}".format(', '.join(
+        '/'.join(key) for key in slowest)), bold=True)
+
+    series = dict(totals)
+    for key in steps:
+        series['/'.join(key)] = [step['seconds'] for step in steps[key]]
+    regressions = []
+    for name in sorted(series):
+        (last, median) = regression(series[name], baseline, threshold)
+        if last is not None:
+            regressions.append((name, last, median))
+    if regressions:
+        click.secho("\nRegressions:", fg='red', bold=True)
+        for (name, last, median) in regressions:
+            click.secho("    {0}: {1:.2f}s in the last run, baseline {2:.2f}s".format(
+                name, last, median), fg='red')
+    else:
+        click.secho("\nNo regressions against the last {0} runs".format(baseline),
+                    fg='green')
+
+
+@cli.command()
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--target', '-t', multiple=True,
+              help='Plugin directory to check (may be repeated). Overrides \
+              the targets in the [deploy] section of the config')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print the status as JSON')
+def status(config, target, as_json):
+    """ Show what is out of date: compiled UI, resource and translation
+    files older than their sources, and deployed files that are missing,
+    differ from the source or are no longer in the config. Unchanged files
+    are checked against the deploy manifest without being read."""
+    cfg = get_config(config)
+    items, errors = install_set(cfg)
+    manifest = read_manifest('deploy')
+    result = {'compile': compile_status(cfg), 'deploy': {}}
+    for plugin_dir in get_deploy_targets(cfg, target):
+        result['deploy'][plugin_dir] = deployment_status(
+            plugin_dir, items, manifest.get(os.path.abspath(plugin_dir), {}))
+
+    if as_json:
+        click.echo(json.dumps(result, indent=1, sort_keys=True,
+                              separators=(',', ': ')))
+        return
+    if result['compile']:
+        for (output, source) in result['compile']:
+            click.secho("{0} is out of date ({1} changed)".format(output, source),
+                        fg='yellow')
+    else:
+        click.secho("Compiled files are up to date", fg='green')
+    for plugin_dir in sorted(result['deploy']):
+        deployed = result['deploy'][plugin_dir]
+        if not deployed['deployed']:
+            click.secho("{0}: not deployed".format(plugin_dir), fg='yellow')
+            continue
+        stale = deployed['missing'] or deployed['modified'] or deployed['orphaned']
+        click.secho("{0}: {1} up to date, {2} missing, {3} modified, "
+                    "{4} not in config".format(
+                        plugin_dir, deployed['unchanged'],
+                        len(deployed['missing']), len(deployed['modified']),
+                        len(deployed['orphaned'])),
+                    fg='yellow' if stale else 'green')
+        for key, label in [('missing', 'missing'), ('modified', 'modified'),
+                           ('orphaned', 'not in config')]:
+            for path in deployed[key]:
+                click.echo("    {0}: {1}".format(label, path))
+
+
+@cli.command()
+@click.option('--config', default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+def list(config):
+    """ List the contents of the configuration file """
+    if os.path.exists(config):
+        with open(config) as cfg:
+            for line in cfg:
+                print line[:-1]
+    else:
+        click.secho("There is no {0} file in the current directory".format(config), fg='red')
+        click.secho("We can't do anything without it", fg='red')
+
+
+@cli.command()
+@click.option('--name', default='pb_tool.cfg',
+              help='Name of the config file to create if other than pb_tool.cfg')
+def create(name):
+    """
+    Create a config file based on source files in the current directory
+    and its subdirectories. Files matched by .gitignore are skipped.
+    """
+    template = Template(config_template())
+    # guess the plugin name
+    try:
         metadata = ConfigParser.ConfigParser()
         metadata.read('metadata.txt')
         cfg_name = metadata.get('general', 'name')
@@ -412,39 +2055,54 @@ def create(name):
         print "Unable to get the name of your plugin from metadata.txt"
         cfg_name = click.prompt("Name of the plugin:")
 
-    # get the list of python files
-    py_files = glob.glob('*.py')
-
-    # guess the main dialog ui file
-    main_dlg = glob.glob('*_dialog_base.ui')
-
-    # get the other ui files
-    other_ui = glob.glob('*.ui')
-    # remove the main dialog file
-    try:
-        for ui in main_dlg:
-            other_ui.remove(ui)
-    except:
-        # don't care if we didn't find it
-        pass
-
-    # get the resource files (.qrc)
-    resources = glob.glob("*.qrc")
+    # classify the files found in a single walk of the plugin tree
+    rules = DEFAULT_IGNORE + read_ignore_rules('.gitignore')
+    py_files = []
+    main_dlg = []
+    other_ui = []
+    resources = []
+    extras = []
+    locales = []
+    packages = set()
+    for path in walk_tree('.', rules):
+        parts = path.split('/')
+        (base, ext) = os.path.splitext(parts[-1])
+        if ext == '.py':
+            if len(parts) == 1:
+                py_files.append(path)
+            elif parts[-1] == '__init__.py' and len(parts) == 2 and \
+                    parts[0] not in ('test', 'tests', 'help'):
+                packages.add(parts[0])
+        elif ext == '.ui':
+            if len(parts) == 1 and base.endswith('_dialog_base'):
+                main_dlg.append(path)
+            else:
+                other_ui.append(path)
+        elif ext == '.qrc':
+            resources.append(path)
+        elif len(parts) == 1 and (ext == '.png' or path == 'metadata.txt'):
+            extras.append(path)
+        elif ext == '.ts' and len(parts) == 2 and parts[0] == 'i18n':
+            locales.append(parts[-1])
 
-    extras = glob.glob('*.png') + glob.glob('metadata.txt')
+    # compiled ui and resource modules are deployed from their sources
+    generated = set('{0}.py'.format(os.path.splitext(ui)[0]) for ui in other_ui)
+    generated.update('{0}_rc.py'.format(os.path.splitext(res)[0])
+                     for res in resources)
+    py_files = [f for f in py_files if f not in generated]
 
-    locale_list = glob.glob('i18n/*.ts')
-    locales = []
-    for locale in locale_list:
-        locales.append(os.path.basename(locale))
+    extra_dirs = sorted(packages)
+    if locales:
+        extra_dirs.append('i18n')
 
     cfg = template.substitute(Name=cfg_name,
-                              PythonFiles=' '.join(py_files),
-                              MainDialog=' '.join(main_dlg),
-                              CompiledUiFiles=' '.join(other_ui),
-                              Resources=' '.join(resources),
-                              Extras=' '.join(extras),
-                              Locales=' '.join(locales))
+                              PythonFiles=' '.join(sorted(py_files)),
+                              MainDialog=' '.join(sorted(main_dlg)),
+                              CompiledUiFiles=' '.join(sorted(other_ui)),
+                              Resources=' '.join(sorted(resources)),
+                              Extras=' '.join(sorted(extras)),
+                              ExtraDirs=' '.join(extra_dirs),
+                              Locales=' '.join(sorted(locales)))
 
     fname = name
     if os.path.exists(fname):
@@ -452,12 +2110,353 @@ def create(name):
         if not confirm:
             fname = click.prompt('Enter a name for the config file:')
 
-    with open(fname, 'w') as f:
+    with atomic_write(fname, 'w') as f:
         f.write(cfg)
 
     print "Created new config file in {0}".format(fname)
 
 
+def check_files(cfg):
+    """ Check that every file and directory referenced by the config,
+    its .qrc files and metadata.txt exists. All paths are resolved
+    against a single scan of the plugin directory.
+
+    :returns: a list of problems and a list of warnings
+    """
+    files, dirs = tree_index()
+    problems = []
+    warnings = []
+
+    def check_file(path, what):
+        if os.path.normpath(path) not in files:
+            problems.append("{0} {1} does not exist".format(what, path))
+            return False
+        return True
+
+    for (option, what) in [('python_files', 'Python file'),
+                           ('main_dialog', 'Main dialog'),
+                           ('compiled_ui_files', 'UI file'),
+                           ('extras', 'Extra file')]:
+        for path in cfg_get(cfg, 'files', option).split():
+            check_file(path, what)
+
+    for qrc in cfg_get(cfg, 'files', 'resource_files').split():
+        if check_file(qrc, 'Resource file'):
+            try:
+                entries = qrc_files(qrc)
+            except ElementTree.ParseError as oops:
+                problems.append("Unable to parse {0}: {1}".format(qrc, oops))
+                continue
+            for entry in entries:
+                entry = os.path.normpath(entry)
+                if entry not in files and entry not in dirs:
+                    problems.append("{0} listed in {1} does not exist".format(
+                        entry, qrc))
+
+    for xdir in cfg_get(cfg, 'files', 'extra_dirs').split():
+        if os.path.normpath(xdir) not in dirs:
+            problems.append("Extra directory {0} does not exist".format(xdir))
+
+    for locale in cfg_get(cfg, 'files', 'locales').split():
+        (name, ext) = os.path.splitext(locale)
+        check_file(os.path.join('i18n', name + '.ts'), 'Translation file')
+
+    help_dir = cfg_get(cfg, 'help', 'dir')
+    if help_dir and os.path.normpath(help_dir) not in dirs:
+        if 'help' in dirs:
+            warnings.append("Help directory {0} has not been built yet (use "
+                            "pb_tool doc)".format(help_dir))
+        else:
+            problems.append("Help directory {0} does not exist".format(help_dir))
+
+    if 'metadata.txt' not in files:
+        problems.append("metadata.txt does not exist")
+    else:
+        if 'metadata.txt' not in cfg_get(cfg, 'files', 'extras').split():
+            warnings.append("metadata.txt is not listed in extras and won't "
+                            "be deployed")
+        metadata = ConfigParser.ConfigParser()
+        try:
+            metadata.read('metadata.txt')
+        except ConfigParser.Error as oops:
+            problems.append("Unable to parse metadata.txt: {0}".format(
+                oops.message))
+        else:
+            for item in ['name', 'description', 'version',
+                         'qgisMinimumVersion', 'email', 'author']:
+                if not cfg_get(metadata, 'general', item):
+                    problems.append(
+                        "metadata.txt is missing the mandatory {0} item".format(
+                            item))
+            icon = cfg_get(metadata, 'general', 'icon')
+            if icon:
+                check_file(icon, 'Icon')
+    return problems, warnings
+
+
+_tree_index = {}
+
+
+def tree_index(root='.'):
+    """ Scan the tree below root once and return the sets of relative
+    file and directory paths. The scan is cached for the life of the
+    process. """
+    if root not in _tree_index:
+        files = set()
+        dirs = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in ('.git', MANIFEST_DIR)]
+            for dname in dirnames:
+                dirs.add(os.path.normpath(os.path.join(dirpath, dname)))
+            for fname in filenames:
+                files.add(os.path.normpath(os.path.join(dirpath, fname)))
+        _tree_index[root] = (files, dirs)
+    return _tree_index[root]
+
+
+# Ignore rules applied before any .gitignore rules when scanning a plugin
+DEFAULT_IGNORE = [(False, False, True, re.compile(fnmatch.translate(p)))
+                  for p in ['.git', MANIFEST_DIR, '__pycache__', 'build']] + \
+                 [(False, False, False, re.compile(fnmatch.translate(p)))
+                  for p in ['*.pyc', '*.pyo', '*.zip', '*~', '*.swp']]
+
+
+def read_ignore_rules(path):
+    """ Read .gitignore style rules from path.
+
+    :returns: a list of (negate, anchored, dir_only, regex) tuples, empty
+        if path doesn't exist
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return []
+    return [ignore_rule(line) for line in lines
+            if line.strip() and not line.startswith('#')]
+
+
+def ignore_rule(line):
+    """ Parse a .gitignore style pattern into a (negate, anchored,
+    dir_only, regex) rule """
+    line = line.rstrip()
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    # a leading **/ matches in any directory
+    anywhere = line.startswith('**/')
+    if anywhere:
+        line = line[3:]
+    # patterns with a slash are matched against the whole path
+    anchored = '/' in line
+    line = line.lstrip('/')
+    pattern = glob_regex(line)
+    if anywhere and anchored:
+        pattern = '(?:.*/)?' + pattern
+    return (negate, anchored, dir_only, re.compile(pattern + r'\Z'))
+
+
+def glob_regex(glob):
+    """ Translate a .gitignore style glob into a regular expression. Unlike
+    with fnmatch, * and ? don't match a /, while ** matches anything and
+    /**/ matches zero or more directories. """
+    parts = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        if glob.startswith('/**/', i):
+            parts.append('/(?:.*/)?')
+            i += 4
+        elif glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif glob[i] == '[':
+            # a character class, as in fnmatch.translate
+            j = i + 1
+            if j < n and glob[j] == '!':
+                j += 1
+            if j < n and glob[j] == ']':
+                j += 1
+            while j < n and glob[j] != ']':
+                j += 1
+            if j >= n:
+                parts.append('\\[')
+                i += 1
+            else:
+                chars = glob[i + 1:j].replace('\\', '\\\\')
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                parts.append('[{0}]'.format(chars))
+                i = j + 1
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return ''.join(parts)
+
+
+def is_ignored(path, is_dir, rules):
+    """ Return True if the relative path is ignored by rules. As with
+    git, the last matching rule wins. """
+    ignored = False
+    name = path.rsplit('/', 1)[-1]
+    for (negate, anchored, dir_only, regex) in rules:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(path if anchored else name):
+            ignored = not negate
+    return ignored
+
+
+def is_included(path, rules):
+    """ Return True if the relative file path is selected by include
+    rules, which match the way ignore rules do: a rule selects the file if
+    it matches the file or one of the directories it is in (so a
+    directory rule like images/ selects everything below images). The
+    last matching rule wins. """
+    parts = path.split('/')
+    candidates = [(path, parts[-1], False)] + [
+        ('/'.join(parts[:i]), parts[i - 1], True) for i in range(1, len(parts))]
+    included = False
+    for (negate, anchored, dir_only, regex) in rules:
+        if any(regex.match(full if anchored else name)
+               for (full, name, is_dir) in candidates
+               if is_dir or not dir_only):
+            included = not negate
+    return included
+
+
+def walk_tree(root='.', rules=()):
+    """ Walk the tree below root in a single pass, yielding the relative
+    path (using / as separator) of each file that isn't ignored by rules.
+    Ignored directories are never descended into. """
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        top = os.path.join(root, rel) if rel else root
+        if scandir:
+            entries = [(e.name, e.is_dir()) for e in scandir(top)]
+        else:
+            entries = [(n, os.path.isdir(os.path.join(top, n)))
+                       for n in os.listdir(top)]
+        for (name, is_dir) in entries:
+            path = rel + '/' + name if rel else name
+            if is_ignored(path, is_dir, rules):
+                continue
+            if is_dir:
+                pending.append(path)
+            else:
+                yield path
+
+
+def qrc_files(qrc):
+    """ Return the paths of the files listed in the .qrc file, relative
+    to the current directory """
+    base = os.path.dirname(qrc)
+    tree = ElementTree.parse(qrc)
+    return [os.path.join(base, node.text.strip())
+            for node in tree.iter('file') if node.text]
+
+
+def compile_status(cfg):
+    """ Return (output, source) pairs for compiled UI, resource and
+    translation files that are out of date with their sources """
+    stale = []
+    built = read_manifest('compile')
+    for ui in cfg_get(cfg, 'files', 'compiled_ui_files').split():
+        output = '{0}.py'.format(os.path.splitext(ui)[0])
+        if os.path.exists(ui) and needs_build(cfg, output, [ui], built):
+            stale.append((output, ui))
+    rcc_mode = resource_mode(cfg) == 'rcc'
+    for res in cfg_get(cfg, 'files', 'resource_files').split():
+        (base, ext) = os.path.splitext(res)
+        output = '{0}.rcc'.format(base) if rcc_mode else '{0}_rc.py'.format(base)
+        if not os.path.exists(res):
+            continue
+        if needs_build(cfg, output, resource_inputs(res), built):
+            stale.append((output, res))
+        elif rcc_mode and not os.path.exists('{0}_rc.py'.format(base)):
+            # the loader module is written along with the .rcc file
+            stale.append(('{0}_rc.py'.format(base), res))
+    for locale in cfg_get(cfg, 'files', 'locales').split():
+        (name, ext) = os.path.splitext(locale)
+        ts = os.path.join('i18n', name + '.ts')
+        qm = os.path.join('i18n', name + '.qm')
+        if os.path.exists(ts) and file_changed(ts, qm):
+            stale.append((qm, ts))
+    return stale
+
+
+def deployment_status(plugin_dir, items, recorded):
+    """ Compare a deployed plugin with its install set.
+
+    Files whose source and deployed stat match the deploy manifest entry
+    are up to date without being read; only files whose stat changed but
+    whose size didn't are hashed.
+
+    :returns: a dict with the number of unchanged files and lists of the
+        missing, modified and orphaned (deployed but not in the config)
+        files
+    """
+    result = {'deployed': os.path.isdir(plugin_dir), 'unchanged': 0,
+              'missing': [], 'modified': [], 'orphaned': []}
+    if not result['deployed']:
+        return result
+    expected = set()
+    for (source, target) in items:
+        expected.add(os.path.normpath(target))
+        try:
+            src_stat = os.stat(source)
+        except OSError:
+            continue
+        dest = os.path.join(plugin_dir, target)
+        try:
+            dest_stat = os.stat(dest)
+        except OSError:
+            result['missing'].append(target)
+            continue
+        entry = recorded.get(target, {})
+        current = deploy_entry(source, src_stat, dest_stat)
+        if all(entry.get(key) == current[key]
+               for key in ('source', 'stat', 'dest')):
+            result['unchanged'] += 1
+        elif src_stat.st_size != dest_stat.st_size:
+            result['modified'].append(target)
+        elif (int(src_stat.st_mtime) == int(dest_stat.st_mtime) or
+              len(set(hash_files([source, dest]).values())) == 1):
+            result['unchanged'] += 1
+        else:
+            result['modified'].append(target)
+    for dirpath, dirnames, filenames in os.walk(plugin_dir):
+        dirnames[:] = [d for d in dirnames if d != '__pycache__']
+        for fname in filenames:
+            if fname.endswith(('.pyc', '.pyo')):
+                continue
+            rel = os.path.relpath(os.path.join(dirpath, fname), plugin_dir)
+            if rel not in expected:
+                result['orphaned'].append(rel)
+    result['orphaned'].sort()
+    return result
+
+
+def resource_inputs(res):
+    """ Return the resource file and the existing files it lists """
+    try:
+        assets = qrc_files(res)
+    except ElementTree.ParseError:
+        assets = []
+    return [res] + [asset for asset in assets if os.path.isfile(asset)]
+
+
 def check_cfg(cfg, section, name):
     try:
         cfg.get(section, name)
@@ -505,9 +2504,12 @@ def compiled_resource(cfg):
     try:
         res_files = cfg.get('files', 'resource_files').split()
         compiled = []
+        rcc_mode = resource_mode(cfg) == 'rcc'
         for res in res_files:
             (base, ext) = os.path.splitext(res)
             compiled.append('{0}_rc.py'.format(base))
+            if rcc_mode:
+                compiled.append('{0}.rcc'.format(base))
         #print "Compiled resource files: {}".format(compiled)
         return compiled
     except ConfigParser.NoSectionError as oops:
@@ -515,63 +2517,283 @@ def compiled_resource(cfg):
         sys.exit(1)
 
 
-def compile_files(cfg):
-    # Compile all ui and resource files
-    # TODO add changed detection
+def compile_files(cfg, plan=False):
+    # Compile all ui and resource files. The compilers run concurrently
+    # through the job executor. With plan, only print the tool runs that
+    # are needed.
     #cfg = get_config(config)
+    start = time.time()
+    configure_jobs(cfg)
+    if plan:
+        pending = compile_tasks(cfg, read_manifest('compile'), cached=True)
+        print_plan_jobs([job for (job, output, inputs, kind) in pending],
+                        sum(file_size(path) for (job, output, inputs, kind)
+                            in pending for path in inputs))
+        return
+    # the lock keeps other runs from building the same outputs meanwhile
+    with locked(lock_path('compile')):
+        built = read_manifest('compile')
+        pending = compile_tasks(cfg, built)
+        jobs = [job for (job, output, inputs, kind) in pending]
+        for (job, output, inputs, kind) in pending:
+            print "Compiling {0} to {1}".format(job.name, output)
+        ok = run_jobs(jobs)
+        counts = record_compiled(cfg, pending, built)
+        write_manifest(built, 'compile')
+    sources = [path for option in ('compiled_ui_files', 'resource_files')
+               for path in cfg_get(cfg, 'files', option).split()
+               if os.path.exists(path)]
+    record_step('compile', time.time() - start, len(sources),
+                sum(file_size(path) for (job, output, inputs, kind) in pending
+                    for path in inputs),
+                len(sources) - len(pending), len(pending))
+    report_jobs(jobs)
+    ok = ok and all(job.status == 'ok' for job in jobs)
+    if check_path('pyuic4'):
+        print "Compiled {0} UI files".format(counts['UI'])
+    print "Compiled {0} resource files".format(counts['resource'])
+    if not ok:
+        sys.exit(1)
+
+
+def compile_tasks(cfg, built, say=click.secho, cached=False):
+    """ Return a (job, output, inputs, kind) tuple for each UI and resource
+    file that is out of date. Skipped files and missing tools are reported
+    through say. The jobs write to the partial path of each output, which
+    record_compiled renames into place. With cached (for planning), files
+    are only looked up in the stat index, and those it misses are taken to
+    need a rebuild. """
+    timeout = tool_timeout(cfg)
+    # (job, output, inputs, kind) for each file to compile
+    pending = []
 
     # check to see if we have pyuic4
     pyuic4 = check_path('pyuic4')
 
     if not pyuic4:
-        print "pyuic4 is not in your path---unable to compile your ui files"
+        say("pyuic4 is not in your path---unable to compile your ui files")
     else:
         ui_files = cfg.get('files', 'compiled_ui_files').split()
-        ui_count = 0
         for ui in ui_files:
             if os.path.exists(ui):
                 (base, ext) = os.path.splitext(ui)
                 output = "{0}.py".format(base)
-                if file_changed(ui, output):
-                    print "Compiling {0} to {1}".format(ui, output)
-                    subprocess.check_call([pyuic4, '-o', output, ui])
-                    ui_count += 1
+                if needs_build(cfg, output, [ui], built, cached):
+                    pending.append((Job(ui, [pyuic4, '-o', partial_path(output),
+                                             ui], timeout=timeout),
+                                    output, [ui], 'UI'))
                 else:
-                    print "Skipping {0} (unchanged)". format(ui)
+                    say("Skipping {0} (unchanged)". format(ui))
             else:
-                print "{0} does not exist---skipped".format(ui)
-        print "Compiled {0} UI files".format(ui_count)
+                say("{0} does not exist---skipped".format(ui))
 
-    # check to see if we have pyrcc4
-    pyrcc4 = check_path('pyrcc4')
+    if resource_mode(cfg) == 'rcc':
+        pending.extend(rcc_jobs(cfg, built, say, cached))
+    else:
+        # check to see if we have pyrcc4
+        pyrcc4 = BUILTIN_RCC if builtin_rcc(cfg) else check_path('pyrcc4')
 
-    if not pyrcc4:
-        click.secho("pyrcc4 is not in your path---unable to compile your resource file(s)",
+        if not pyrcc4:
+            say("pyrcc4 is not in your path---unable to compile your resource file(s)",
                 fg='red')
-    else:
-        res_files = cfg.get('files', 'resource_files').split()
-        res_count = 0
-        for res in res_files:
-            if os.path.exists(res):
-                (base, ext) = os.path.splitext(res)
-                output = "{0}_rc.py".format(base)
-                if file_changed(res, output):
-                    print "Compiling {0} to {1}".format(res, output)
-                    subprocess.check_call([pyrcc4, '-o', output, res])
-                    res_count += 1
+        else:
+            res_files = cfg.get('files', 'resource_files').split()
+            for res in res_files:
+                if os.path.exists(res):
+                    (base, ext) = os.path.splitext(res)
+                    output = "{0}_rc.py".format(base)
+                    inputs = resource_inputs(res)
+                    if needs_build(cfg, output, inputs, built, cached):
+                        pending.append((resource_job(
+                            res, [pyrcc4, '-o', partial_path(output), res],
+                            timeout), output, inputs, 'resource'))
+                    else:
+                        say("Skipping {0} (unchanged)". format(res))
                 else:
-                    print "Skipping {0} (unchanged)". format(res)
+                    say("{0} does not exist---skipped".format(res))
+    return pending
+
+
+def record_compiled(cfg, pending, built):
+    """ Move the outputs of the compile tasks whose job succeeded into
+    place and record their builds (and write the loaders of binary
+    resources). The partial outputs of failed jobs are removed.
+
+    :returns: the number of UI and resource files compiled, keyed by kind
+    """
+    counts = {'UI': 0, 'resource': 0}
+    for (job, output, inputs, kind) in pending:
+        if job.status != 'ok':
+            discard_file(partial_path(output))
+        elif not os.path.exists(partial_path(output)):
+            job.status = 'failed'
+            job.output += "{0} didn't write {1}".format(job.name, output)
+        else:
+            replace_file(partial_path(output), output)
+            if output.endswith('.rcc'):
+                write_rcc_loader(inputs[0], output)
+            record_build(cfg, output, inputs, built)
+            counts[kind] += 1
+    return counts
+
+
+def resource_mode(cfg):
+    """ Return how resource files are compiled: py (a Python module with
+    the resource data embedded, the default) or rcc (a binary .rcc file
+    registered by a small loader module) """
+    return cfg_get(cfg, 'files', 'resource_mode', 'py').strip() or 'py'
+
+
+def builtin_rcc(cfg):
+    """ Return True if resource files are compiled by pb_tool itself
+    rather than pyrcc4 or rcc (rcc_tool in the [build] section) """
+    return cfg_get(cfg, 'build', 'rcc_tool').strip().lower() not in (
+        '1', 'yes', 'true', 'on')
+
+
+def resource_job(res, cmd, timeout=None):
+    """ Return the job compiling a resource file: an in-process job using
+    compile_qrc for the built-in compiler, otherwise a tool run """
+    if cmd[0] != BUILTIN_RCC:
+        return Job(res, cmd, timeout=timeout)
+    return Job(res, cmd, func=lambda: compile_qrc(res, cmd[-2],
+                                                  '-binary' in cmd))
+
+
+def rcc_jobs(cfg, built, say=click.secho, cached=False):
+    """ Return the jobs compiling the resource files to binary .rcc files
+    using the built-in compiler or rcc. Each .rcc file gets a <base>_rc.py
+    loader module (written by write_rcc_loader) that registers it by path
+    so Qt can map it instead of Python holding the data. cached is as for
+    compile_tasks. """
+    rcc = BUILTIN_RCC if builtin_rcc(cfg) else None
+    for binary in ['rcc', 'rcc-qt4']:
+        rcc = rcc or check_path(binary)
+        if rcc:
+            break
+    if not rcc:
+        say("rcc is not in your path---unable to compile your resource file(s)",
+            fg='red')
+        return []
+    pending = []
+    for res in cfg.get('files', 'resource_files').split():
+        if os.path.exists(res):
+            (base, ext) = os.path.splitext(res)
+            output = "{0}.rcc".format(base)
+            loader = "{0}_rc.py".format(base)
+            inputs = resource_inputs(res)
+            if (needs_build(cfg, output, inputs, built, cached) or
+                    not os.path.exists(loader)):
+                pending.append((resource_job(
+                    res, [rcc, '-binary', '-o', partial_path(output), res],
+                    tool_timeout(cfg)), output, inputs, 'resource'))
             else:
-                print "{0} does not exist---skipped".format(res)
-        print "Compiled {0} resource files".format(res_count)
+                say("Skipping {0} (unchanged)". format(res))
+        else:
+            say("{0} does not exist---skipped".format(res))
+    return pending
+
+
+def write_rcc_loader(res, output):
+    """ Write the <base>_rc.py loader for a compiled .rcc file """
+    loader = "{0}_rc.py".format(os.path.splitext(output)[0])
+    with atomic_write(loader, 'w') as f:
+        f.write(Template(rcc_loader_template()).substitute(
+            Source=res, Rcc=os.path.basename(output)))
+
+
+def listener_template():
+    """
+    :return: the template for the reload listener module run in QGIS
+    """
+    template = """# -*- coding: utf-8 -*-
+
+# Reload listener for QGIS, installed by pb_tool listener
+#
+# Accepts "reload <plugin name>" requests from pb_tool on local port $Port
+# and reloads (or loads and starts) the plugin.
+
+from PyQt4.QtNetwork import QHostAddress, QTcpServer
+from qgis.core import QgsMessageLog
+from qgis import utils
+
+PORT = $Port
+
+
+class ReloadListener(QTcpServer):
+
+    def __init__(self, port=PORT):
+        QTcpServer.__init__(self)
+        self.newConnection.connect(self.accept_connection)
+        if not self.listen(QHostAddress.LocalHost, port):
+            QgsMessageLog.logMessage(
+                'pb_tool reload listener: {0}'.format(self.errorString()),
+                'pb_tool')
+
+    def accept_connection(self):
+        while self.hasPendingConnections():
+            connection = self.nextPendingConnection()
+            connection.readyRead.connect(
+                lambda connection=connection: self.read_request(connection))
+
+    def read_request(self, connection):
+        if not connection.canReadLine():
+            return
+        request = str(connection.readLine()).strip()
+        (command, space, name) = request.partition(' ')
+        try:
+            if command != 'reload' or not name:
+                raise ValueError('unknown request')
+            utils.updateAvailablePlugins()
+            if name in utils.plugins:
+                utils.reloadPlugin(name)
+            elif not (utils.loadPlugin(name) and utils.startPlugin(name)):
+                raise ValueError('{0} could not be started'.format(name))
+            reply = 'ok'
+        except Exception as e:
+            reply = 'error {0}'.format(e)
+        connection.write(reply + '\\n')
+        connection.flush()
+        connection.disconnectFromHost()
+
+
+listener = ReloadListener()
+"""
+    return template
+
+
+def rcc_loader_template():
+    """
+    :return: the template for the loader module of a binary .rcc file
+    """
+    template = """# -*- coding: utf-8 -*-
+
+# Resource loader for $Rcc, compiled from $Source by pb_tool
+#
+# WARNING! All changes made in this file will be lost!
+
+import os
+from PyQt4 import QtCore
+
+_rcc = os.path.join(os.path.dirname(os.path.abspath(__file__)), '$Rcc')
+
+
+def qInitResources():
+    QtCore.QResource.registerResource(_rcc)
+
+
+def qCleanupResources():
+    QtCore.QResource.unregisterResource(_rcc)
+
+
+qInitResources()
+"""
+    return template
 
 
 def copy(source, destination):
     """Copy files recursively.
 
-    Taken from: http://www.pythoncentral.io/
-                how-to-recursively-copy-a-directory-folder-in-python/
-
     :param source: Source directory.
     :type source: str
 
@@ -579,15 +2801,16 @@ def copy(source, destination):
     :type destination: str
 
     """
-    try:
-        #shutil.copytree(source, destination)
-        copy_tree(source, destination)
-    except OSError as e:
-        # If the error was caused because the source wasn't a directory
-        if e.errno == errno.ENOTDIR:
-            shutil.copy(source, destination)
-        else:
-            print('Directory not copied. Error: %s' % e)
+    if os.path.isdir(source):
+        pairs = [(src, os.path.join(destination, target))
+                 for (src, target) in tree_files(source, '')]
+    else:
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source))
+        pairs = [(source, destination)]
+    for (i, (dest_stat, error)) in enumerate(copy_files(pairs)):
+        if error:
+            print('Not copied: {0}. Error: {1}'.format(pairs[i][0], error))
 
 
 def get_plugin_directory():
@@ -629,12 +2852,23 @@ compiled_ui_files: $CompiledUiFiles
 # Resource file(s) that will be compiled
 resource_files: $Resources
 
+# How resource files are compiled: py embeds the resources in a
+# <name>_rc.py module, rcc compiles them to a binary <name>.rcc file
+# that is loaded (memory mapped) by a small <name>_rc.py module.
+resource_mode: py
+
 # Other files required for the plugin
 extras: $Extras
 
 # Other directories to be deployed with the plugin.
 # These must be subdirectories under the plugin directory
-extra_dirs:
+extra_dirs: $ExtraDirs
+
+# Files and directories in the extra directories that are not deployed or
+# packaged (.gitignore style patterns). If include is set, only matching
+# files are deployed.
+#exclude: .git .svn .hg __pycache__ *.pyc *.pyo *~ *.swp .DS_Store
+#include:
 
 # ISO code(s) for any locales (translations), separated by spaces.
 # Corresponding .ts files must exist in the i18n directory
@@ -645,6 +2879,19 @@ locales: $Locales
 dir: help/build/html
 # the name of the directory to target in the deployed plugin
 target: help
+# files and directories in the built help that are not deployed
+#exclude: .doctrees .buildinfo
+
+#[build]
+# How out of date files are found when compiling, deploying and packaging:
+# mtime compares modification times, hash compares content hashes and git
+# takes the hashes of unmodified tracked files from the git index.
+#change_detection: mtime
+
+#[deploy]
+# Plugin directories to deploy to if other than .qgis2/python/plugins,
+# separated by spaces. The plugin is built once and synced to each.
+#targets: ~/.qgis2/python/plugins ~/lab/.qgis2/python/plugins
 """
     return template
 
@@ -684,3 +2931,2145 @@ def file_changed(infile, outfile):
         return infile_s.st_mtime > outfile_s.st_mtime
     except:
         return True
+
+
+def cfg_get(cfg, section, name, default=''):
+    """ Return an optional config value, or default if it isn't set """
+    try:
+        return cfg.get(section, name)
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        return default
+
+
+def read_manifest(name='manifest', directory=MANIFEST_DIR):
+    """ Read the named build manifest from the .pb_tool directory """
+    path = os.path.join(directory, '{0}.json'.format(name))
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(manifest, name='manifest', directory=MANIFEST_DIR):
+    """ Write the named build manifest to the .pb_tool directory """
+    make_dirs(directory)
+    path = os.path.join(directory, '{0}.json'.format(name))
+    with atomic_write(path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+
+
+def make_dirs(path):
+    """ Create path and its parents, if another run hasn't already """
+    try:
+        os.makedirs(path)
+    except OSError as oops:
+        if oops.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def temp_file(path):
+    """ Create a temporary file next to path (so it can be renamed over
+    path) with the permissions of a new file.
+
+    :returns: the open file descriptor and the name of the file
+    """
+    (fd, tmp) = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(path)), suffix='.tmp',
+        dir=os.path.dirname(path) or '.')
+    if os.name != 'nt':
+        os.fchmod(fd, 0666 & ~_umask)
+    return fd, tmp
+
+
+def replace_file(source, dest):
+    """ Rename source to dest, replacing dest in one step """
+    if os.name == 'nt':
+        # MOVEFILE_REPLACE_EXISTING; os.rename won't replace on Windows
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(source),
+                                                  unicode(dest), 1):
+            raise ctypes.WinError()
+    else:
+        os.rename(source, dest)
+
+
+def discard_file(path):
+    """ Remove path if it exists """
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """ Write path through a temporary file that replaces it when the
+    block completes, so other runs (and QGIS) never see a partly written
+    file. If the block fails, path is left as it was. """
+    (fd, tmp) = temp_file(path)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        replace_file(tmp, path)
+    except BaseException:
+        discard_file(tmp)
+        raise
+
+
+def partial_path(output):
+    """ Return where a tool writes output before it is renamed into place
+    (see record_compiled) """
+    return '{0}.part'.format(output)
+
+
+def lock_path(name, directory=MANIFEST_DIR):
+    """ Return the lock file guarding the named manifest and the files
+    built with it """
+    return os.path.join(directory, '{0}.lock'.format(name))
+
+
+def target_lock(plugin_dir):
+    """ Return the lock file guarding a deployed plugin directory. It is
+    kept in the per-user lock directory, named by a hash of the plugin
+    directory's real path, so every project and workspace deploying to
+    the same directory takes the same lock. It outlives removing the
+    plugin and leaves nothing in the plugins directory. """
+    digest = hashlib.sha1(os.path.realpath(plugin_dir)).hexdigest()[:16]
+    return lock_path('target-{0}'.format(digest),
+                     os.path.expanduser(USER_LOCK_DIR))
+
+
+def lock_file(path):
+    """ Take an exclusive lock on path, creating it if needed, and wait for
+    any other pb_tool run holding it.
+
+    :returns: the open lock file, for unlock_file
+    """
+    make_dirs(os.path.dirname(path))
+    f = open(path, 'a+')
+    try:
+        if not try_lock(f, False):
+            click.secho("Waiting for another pb_tool run to release {0}".format(
+                path), fg='yellow')
+            while not try_lock(f, True):
+                pass
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def try_lock(f, wait):
+    """ Lock the open file f, waiting for the lock if wait is True.
+
+    :returns: True if the lock was taken
+    """
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(),
+                        fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        else:
+            # locks the first byte; LK_LOCK gives up after 10 seconds
+            f.seek(0)
+            msvcrt.locking(f.fileno(),
+                           msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK, 1)
+        return True
+    except IOError as oops:
+        if oops.errno in (errno.EAGAIN, errno.EACCES, errno.EDEADLK):
+            return False
+        raise
+
+
+def unlock_file(f):
+    """ Release and close a lock file taken by lock_file """
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        f.close()
+
+
+def lock_rank(path):
+    """ Return the level of a lock file in LOCK_ORDER """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return LOCK_ORDER.index(name.split('-')[0])
+
+
+@contextlib.contextmanager
+def locked(*paths):
+    """ Hold exclusive locks on the lock files for the block. The locks
+    are taken in LOCK_ORDER (and by path within a level), and a lock this
+    process already holds is taken again without waiting. A locked block
+    nested in another may only take new locks below those already held,
+    which is checked: if every run keeps to the hierarchy, no two runs can
+    each wait for a lock the other holds. """
+    held = []
+    try:
+        for path in sorted(set(os.path.abspath(path) for path in paths),
+                           key=lambda path: (lock_rank(path), path)):
+            with _locks_guard:
+                entry = _locks.get(path)
+                if entry:
+                    entry[1] += 1
+                else:
+                    if any(lock_rank(other) >= lock_rank(path)
+                           for other in _locks if other not in held):
+                        raise RuntimeError(
+                            "{0} is taken out of lock order".format(path))
+                    _locks[path] = [lock_file(path), 1]
+            held.append(path)
+        yield
+    finally:
+        for path in reversed(held):
+            with _locks_guard:
+                entry = _locks[path]
+                entry[1] -= 1
+                if not entry[1]:
+                    del _locks[path]
+                    unlock_file(entry[0])
+
+
+def hash_file(path):
+    """ Return the content identity of path: the sha1 hex digest git uses
+    for the file as a blob, so it can be compared with the git index """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest = hashlib.sha1('blob {0}\0'.format(size))
+        if size >= MMAP_THRESHOLD:
+            try:
+                view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                view = None
+            if view is not None:
+                try:
+                    digest.update(view)
+                finally:
+                    view.close()
+                return digest.hexdigest()
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_files(paths, cached=False):
+    """ Return the content identity (see hash_file) of each path, keyed by
+    path, or None for paths that don't exist. Like the git index, the stat
+    index remembers the identity of each file with its device, inode,
+    size, modification and change times, so only files whose stat changed
+    are read; those are hashed on a pool of threads. With cached, nothing
+    is read: files missing from the index get None as well. """
+    (index, updates) = stat_index()
+    hashes = {}
+    misses = []
+    for path in paths:
+        key = os.path.abspath(path)
+        try:
+            stat = stat_entry(os.stat(path))
+        except OSError:
+            hashes[path] = None
+            if key in index:
+                del index[key]
+                updates[key] = None
+            continue
+        entry = index.get(key)
+        if entry and entry[:-1] == stat:
+            hashes[path] = entry[-1]
+        else:
+            misses.append((path, key, stat))
+    if cached:
+        hashes.update((miss[0], None) for miss in misses)
+        return hashes
+    if not misses:
+        return hashes
+    started = time.time()
+    if len(misses) > 1:
+        pool = ThreadPool(min(HASH_THREADS, len(misses)))
+        try:
+            digests = pool.map(hash_existing, [miss[0] for miss in misses],
+                               chunksize=1)
+        finally:
+            pool.close()
+    else:
+        digests = [hash_existing(misses[0][0])]
+    for ((path, key, stat), digest) in izip(misses, digests):
+        hashes[path] = digest
+        try:
+            changed = stat_entry(os.stat(path)) != stat
+        except OSError:
+            changed = True
+        # racy files are hashed again next time
+        if (digest and not changed and
+                max(stat[3], stat[4]) < started - RACY_SECONDS):
+            index[key] = updates[key] = stat + [digest]
+    return hashes
+
+
+def hash_existing(path):
+    """ Return the identity of path (see hash_file), or None if it has
+    gone """
+    try:
+        return hash_file(path)
+    except (IOError, OSError):
+        return None
+
+
+def stat_entry(st):
+    """ Return the part of a stat result that tells whether a file changed """
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+
+def stat_index():
+    """ Return the stat index of the current directory: [dev, inode, size,
+    mtime, ctime, identity] for each hashed file, keyed by absolute path,
+    and the entries this run changed in it. The index is read once per
+    directory. """
+    key = os.path.abspath(MANIFEST_DIR)
+    if key not in _stat_index:
+        _stat_index[key] = read_manifest(STAT_INDEX)
+        _stat_updates[key] = {}
+    return _stat_index[key], _stat_updates[key]
+
+
+def save_stat_index():
+    """ Merge the entries this run changed into the stat indexes on disk,
+    along with those other runs saved meanwhile. Called once when the
+    command ends. """
+    for (directory, updates) in _stat_updates.items():
+        if not updates:
+            continue
+        with locked(lock_path(STAT_INDEX, directory)):
+            index = read_manifest(STAT_INDEX, directory)
+            for (path, entry) in updates.items():
+                if entry is None:
+                    index.pop(path, None)
+                else:
+                    index[path] = entry
+            write_manifest(index, STAT_INDEX, directory)
+        updates.clear()
+
+
+def change_detection(cfg):
+    """ Return how out of date files are detected: mtime (compare
+    modification times, the default), hash (compare content hashes with
+    those recorded at the last build) or git (like hash, but taking the
+    hashes of unmodified tracked files from the git index) """
+    mode = cfg_get(cfg, 'build', 'change_detection', 'mtime').strip()
+    return mode if mode in ('hash', 'git') else 'mtime'
+
+
+def needs_build(cfg, output, inputs, built, cached=False):
+    """ Return True if output has to be built from inputs. built holds the
+    input identities recorded by record_build for each output. With
+    cached, inputs missing from the stat index count as changed instead
+    of being hashed. """
+    mode = change_detection(cfg)
+    if mode == 'mtime':
+        return any(file_changed(path, output) for path in inputs)
+    if not os.path.exists(output):
+        return True
+    return built.get(output) != file_identities(inputs, mode, cached)
+
+
+def record_build(cfg, output, inputs, built):
+    """ Record the identities of the inputs output was built from """
+    mode = change_detection(cfg)
+    if mode != 'mtime':
+        built[output] = file_identities(inputs, mode)
+
+
+_git_index = {}
+
+
+def git_index():
+    """ Return the git blob ids of the tracked files below the current
+    directory that are unmodified in the working tree, keyed by relative
+    path. The index is read once per directory; an empty dict is returned
+    outside a git checkout. """
+    key = os.getcwd()
+    if key not in _git_index:
+        ids = {}
+        try:
+            with open(os.devnull, 'w') as devnull:
+                prefix = subprocess.check_output(
+                    ['git', 'rev-parse', '--show-prefix'],
+                    stderr=devnull).strip()
+            staged = subprocess.check_output(['git', 'ls-files', '-s', '-z'])
+            changed = subprocess.check_output(
+                ['git', 'status', '--porcelain', '-z', '--untracked-files=no',
+                 '.'])
+        except (OSError, subprocess.CalledProcessError):
+            staged = changed = ''
+            prefix = ''
+        for record in staged.split('\0'):
+            if record:
+                (info, path) = record.split('\t', 1)
+                (mode, sha, stage) = info.split()
+                if stage == '0':
+                    ids[os.path.normpath(path)] = sha
+        entries = iter(changed.split('\0'))
+        for record in entries:
+            if not record:
+                continue
+            (state, path) = (record[:2], record[3:])
+            if 'R' in state or 'C' in state:
+                # renames and copies are followed by the original path
+                next(entries, None)
+            if path.startswith(prefix):
+                ids.pop(os.path.normpath(path[len(prefix):]), None)
+        _git_index[key] = ids
+    return _git_index[key]
+
+
+def file_identities(paths, mode='hash', cached=False):
+    """ Return a dict of the content identity of each path. In git mode
+    the identities of unmodified tracked files come from the git index;
+    other files are hashed through the stat index (see hash_files, which
+    also explains cached). """
+    index = git_index() if mode == 'git' else {}
+    identities = {}
+    unknown = []
+    for path in paths:
+        identity = index.get(os.path.normpath(path))
+        if identity:
+            identities[path] = identity
+        else:
+            unknown.append(path)
+    identities.update(hash_files(unknown, cached))
+    return identities
+
+
+def source_files(root='.'):
+    """ Return the relative paths of all files below root, skipping
+    hidden and build directories """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith('.') and
+                       d not in ('build', '__pycache__')]
+        for fname in filenames:
+            paths.append(os.path.normpath(os.path.join(dirpath, fname)))
+    return paths
+
+
+def module_name(path):
+    """ Return the dotted module name for the Python file path """
+    parts = os.path.splitext(os.path.normpath(path))[0].split(os.sep)
+    if parts[-1] == '__init__' and len(parts) > 1:
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def scan_imports(path):
+    """ Parse a Python file and return the modules it imports and the
+    string literals that may name other plugin files """
+    imports = []
+    strings = []
+    try:
+        with open(path) as src:
+            tree = ast.parse(src.read(), path)
+    except (SyntaxError, TypeError, IOError):
+        return imports, strings
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append([alias.name, 0, []])
+        elif isinstance(node, ast.ImportFrom):
+            imports.append([node.module or '', node.level,
+                            [alias.name for alias in node.names]])
+        elif isinstance(node, ast.Str):
+            value = node.s
+            if '.' in value and len(value) < 256 and not value.split()[1:]:
+                strings.append(value)
+    return imports, strings
+
+
+def resolve_imports(path, imports, modules):
+    """ Return the paths of the local modules imported by path """
+    package = module_name(path).split('.')
+    if (os.path.basename(path) != '__init__.py' or
+            not os.path.dirname(os.path.normpath(path))):
+        package = package[:-1]
+    resolved = set()
+    for (module, level, names) in imports:
+        if level:
+            bases = [package[:len(package) - level + 1]]
+        else:
+            # Python 2 implicit relative imports are tried first
+            bases = [package, []] if package else [[]]
+        for base in bases:
+            dotted = base + (module.split('.') if module else [])
+            targets = ['.'.join(dotted + [name]) for name in names]
+            if dotted:
+                targets.append('.'.join(dotted))
+            if not any(t in modules for t in targets) and base is not bases[-1]:
+                continue
+            for i in range(1, len(dotted)):
+                targets.append('.'.join(dotted[:i]))
+            resolved.update(modules[t] for t in targets if t in modules)
+            break
+    resolved.discard(os.path.normpath(path))
+    return resolved
+
+
+def import_graph(cfg, manifest):
+    """ Build the import graph of the plugin modules and tests.
+
+    Parsed imports are cached in manifest by file hash so only changed
+    files are parsed again. Compiled UI and resource modules depend on
+    the .ui/.qrc files they are generated from, and modules depend on
+    any plugin file they name in a string literal (e.g. the main dialog
+    loaded with uic.loadUiType).
+
+    :returns: the graph (path -> set of paths it depends on) and the
+        hashes of all files in the graph
+    """
+    files = source_files()
+    py_files = [f for f in files if f.endswith('.py')]
+    by_name = {}
+    for path in files:
+        by_name.setdefault(os.path.basename(path), path)
+    modules = dict((module_name(path), path) for path in py_files)
+
+    graph = {}
+    generated = []
+    for ui in cfg_get(cfg, 'files', 'compiled_ui_files').split():
+        generated.append(('{0}.py'.format(os.path.splitext(ui)[0]), ui))
+    for res in cfg_get(cfg, 'files', 'resource_files').split():
+        generated.append(('{0}_rc.py'.format(os.path.splitext(res)[0]), res))
+    for (output, source) in generated:
+        source = os.path.normpath(source)
+        if not os.path.exists(source):
+            continue
+        output = os.path.normpath(output)
+        modules.setdefault(module_name(output), source)
+        graph.setdefault(source, set())
+        if os.path.exists(output):
+            graph.setdefault(output, set()).add(source)
+
+    mode = 'git' if change_detection(cfg) == 'git' else 'hash'
+    cache = manifest.get('imports', {})
+    scanned = {}
+    hashes = file_identities(py_files, mode)
+    for path in py_files:
+        digest = hashes[path]
+        entry = cache.get(path)
+        if not entry or entry['hash'] != digest:
+            imports, strings = scan_imports(path)
+            entry = {'hash': digest, 'imports': imports, 'strings': strings}
+        scanned[path] = entry
+        deps = graph.setdefault(path, set())
+        deps.update(resolve_imports(path, entry['imports'], modules))
+        for value in entry['strings']:
+            ref = by_name.get(os.path.basename(value))
+            if ref and ref != path:
+                deps.add(ref)
+                graph.setdefault(ref, set())
+    manifest['imports'] = scanned
+
+    hashes.update(file_identities(
+        [path for path in graph if path not in hashes], mode))
+    return graph, hashes
+
+
+def dependents(graph, changed):
+    """ Return the files in graph that depend, directly or transitively,
+    on any of the changed files (including the changed files) """
+    reverse = {}
+    for (path, deps) in graph.items():
+        for dep in deps:
+            reverse.setdefault(dep, set()).add(path)
+    affected = set()
+    pending = [os.path.normpath(path) for path in changed]
+    while pending:
+        path = pending.pop()
+        if path not in affected:
+            affected.add(path)
+            pending.extend(reverse.get(path, ()))
+    return affected
+
+
+def git_changed_files(revision):
+    """ Return the files changed since revision (including untracked
+    files) relative to the current directory, or None if git fails """
+    try:
+        diff = subprocess.check_output(
+            ['git', 'diff', '--name-only', '--relative', revision])
+        untracked = subprocess.check_output(
+            ['git', 'ls-files', '--others', '--exclude-standard'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return set(line for line in (diff + untracked).splitlines() if line)
+
+
+def run_tests(test_files):
+    """ Run the test files using nose if available, otherwise unittest
+    and return the exit status """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.getcwd()] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['QGIS_DEBUG'] = '0'
+    env['QGIS_LOG_FILE'] = os.devnull
+    nose = check_path('nosetests')
+    if nose:
+        cmd = [nose, '-v'] + test_files
+    else:
+        cmd = [sys.executable, '-m', 'unittest', '-v'] + [
+            module_name(path) for path in test_files]
+    return subprocess.call(cmd, env=env)
+
+
+def package_identities(cfg, plugin_dir, level, excluded=None, cached=False):
+    """ Return the content identities of the files in a deployed plugin
+    (and the compression level) for deciding whether its archive is up to
+    date, or None when change detection is by modification time. Files
+    that haven't changed since they were deployed take the identity of
+    their source from the deploy manifest instead of being hashed. Paths
+    for which excluded returns True are left out, as in write_archive.
+    cached is as for hash_files. """
+    if change_detection(cfg) == 'mtime' or not os.path.isdir(plugin_dir):
+        return None
+    recorded = read_manifest('deploy').get(os.path.abspath(plugin_dir), {})
+    identities = {'level': level}
+    unknown = []
+    for dirpath, dirnames, filenames in filtered_walk(plugin_dir, excluded):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            rel = os.path.relpath(path, plugin_dir)
+            st = os.stat(path)
+            entry = recorded.get(rel, {})
+            if entry.get('id') and entry.get('dest') == [st.st_size, st.st_mtime]:
+                identities[rel] = entry['id']
+            else:
+                unknown.append(path)
+    for (path, digest) in hash_files(unknown, cached).items():
+        identities[os.path.relpath(path, plugin_dir)] = digest
+    return identities
+
+
+def filtered_walk(root, excluded=None):
+    """ os.walk the tree below root, leaving out the directories and files
+    for which excluded(path, is_dir) returns True. Paths are passed to
+    excluded relative to root, using / as separator, and excluded
+    directories are not descended into. """
+    for dirpath, dirnames, filenames in os.walk(root):
+        if excluded:
+            rel = os.path.relpath(dirpath, root)
+            prefix = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+            dirnames[:] = [d for d in dirnames if not excluded(prefix + d, True)]
+            filenames = [f for f in filenames if not excluded(prefix + f, False)]
+        yield dirpath, dirnames, filenames
+
+
+def package_entry(zip_path, inputs):
+    """ Return the package manifest entry for an archive built from
+    inputs, or None if the archive doesn't exist """
+    try:
+        st = os.stat(zip_path)
+    except OSError:
+        return None
+    return {'inputs': inputs, 'archive': [st.st_size, st.st_mtime]}
+
+
+# Formats that are already compressed are stored in archives as is
+STORED_EXTENSIONS = set(['.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff',
+                         '.zip', '.gz', '.bz2', '.xz', '.7z', '.ecw', '.jp2',
+                         '.sid', '.qm'])
+
+# Members larger than this are split and compressed in parallel chunks
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def write_archive(zip_path, source_dir, arc_root, level=6, jobs=1,
+                  excluded=None):
+    """ Create a zip archive of source_dir with member names under arc_root.
+
+    Members are deflated in chunks on a thread pool (zlib releases the
+    GIL while compressing) and written in order into a single archive as
+    they arrive, with only a couple of chunks per thread in flight. Each
+    chunk is a raw deflate stream ended with a sync flush, so the
+    concatenated chunks of a member form one valid deflate stream.
+    Already compressed formats, and members deflating doesn't shrink, are
+    stored. Paths for which excluded returns True are left out (see
+    filtered_walk).
+
+    :returns: the number of files added, their total size and the size
+        of the compressed members
+    """
+    members = []
+    for dirpath, dirnames, filenames in filtered_walk(source_dir, excluded):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, source_dir)
+        arc_dir = arc_root if rel == '.' else '/'.join(
+            [arc_root] + rel.split(os.sep))
+        members.append((dirpath, arc_dir + '/', None))
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            ext = os.path.splitext(fname)[1].lower()
+            stored = level == 0 or ext in STORED_EXTENSIONS
+            members.append((path, arc_dir + '/' + fname, stored))
+
+    def chunks():
+        for (path, arcname, stored) in members:
+            if stored is False:
+                size = os.path.getsize(path)
+                offsets = range(0, size, ARCHIVE_CHUNK_SIZE) or [0]
+                for offset in offsets:
+                    yield (path, offset, level,
+                           offset + ARCHIVE_CHUNK_SIZE >= size)
+
+    count = size = compressed = 0
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = ordered_map(pool, deflate_chunk, chunks(), 2 * max(1, jobs))
+        with atomic_write(zip_path) as zip_file:
+            archive = zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED,
+                                      allowZip64=True)
+            try:
+                for (path, arcname, stored) in members:
+                    st = os.stat(path)
+                    zinfo = zipfile.ZipInfo(arcname, archive_date_time(st.st_mtime))
+                    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+                    if stored is None:
+                        zinfo.external_attr |= 0x10
+                        archive.writestr(zinfo, '')
+                        continue
+                    if stored:
+                        archive.write(path, arcname, zipfile.ZIP_STORED)
+                        compressed += st.st_size
+                    else:
+                        zinfo.file_size = st.st_size
+                        compressed += write_member(archive, zinfo, path,
+                                                   results)
+                    count += 1
+                    size += st.st_size
+            finally:
+                archive.close()
+    finally:
+        pool.close()
+    return count, size, compressed
+
+
+def deflate_chunk(task):
+    """ Read and deflate one chunk of an archive member.
+
+    :returns: the raw deflate data, the crc32 and length of the chunk and
+        whether it is the last chunk of the member
+    """
+    (path, offset, level, last) = task
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(ARCHIVE_CHUNK_SIZE)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    block = compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return block, zlib.crc32(data) & 0xffffffff, len(data), last
+
+
+def write_member(archive, zinfo, path, results):
+    """ Write a member to an open ZipFile from its deflated chunks, taken
+    from results as they arrive. The local header goes first and is
+    patched with the crc and sizes once the data is written. A member
+    that deflating didn't make smaller is rewritten stored.
+
+    :returns: the size of the member's data in the archive
+    """
+    # as ZipFile.write, allow for deflate growing the data a little
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = zinfo.compress_size = 0
+    zinfo.header_offset = archive.fp.tell()
+    archive.fp.write(zinfo.FileHeader(zip64))
+    crc = length = written = 0
+    while True:
+        (block, chunk_crc, chunk_length, last) = next(results)
+        archive.fp.write(block)
+        crc = crc32_combine(crc, chunk_crc, chunk_length)
+        length += chunk_length
+        written += len(block)
+        if last:
+            break
+    if written >= length:
+        archive.fp.seek(zinfo.header_offset)
+        archive.fp.truncate()
+        archive.write(path, zinfo.filename, zipfile.ZIP_STORED)
+        return archive.filelist[-1].compress_size
+    end = archive.fp.tell()
+    zinfo.file_size = length
+    zinfo.compress_size = written
+    zinfo.CRC = crc
+    archive.fp.seek(zinfo.header_offset)
+    archive.fp.write(zinfo.FileHeader(zip64))
+    archive.fp.seek(end)
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    return written
+
+
+def ordered_map(pool, func, tasks, window):
+    """ Yield func(task) for each of tasks in order, run on pool with at
+    most window tasks queued or running at a time. Unlike pool.imap, this
+    doesn't read ahead through tasks and hold every finished result until
+    it is consumed. """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def archive_date_time(mtime):
+    """ Return a zip date_time tuple for mtime (zip can't store dates
+    before 1980) """
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def _gf2_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+_crc_operators = {}
+
+
+def crc32_combine(crc1, crc2, len2):
+    """ Return the crc32 of two concatenated blocks given the crc32 of
+    each and the length of the second (the algorithm of zlib's
+    crc32_combine). The operator for each length is cached since all
+    but the last chunk of a member have the same length. """
+    if not len2:
+        return crc1
+    if len2 not in _crc_operators:
+        odd = [0xedb88320] + [1 << n for n in range(31)]
+        even = _gf2_square(odd)
+        odd = _gf2_square(even)
+        # the operator is built by applying zlib's steps to each bit
+        operator = [1 << n for n in range(32)]
+        remaining = len2
+        while True:
+            even = _gf2_square(odd)
+            if remaining & 1:
+                operator = [_gf2_times(even, v) for v in operator]
+            remaining >>= 1
+            if not remaining:
+                break
+            odd = _gf2_square(even)
+            if remaining & 1:
+                operator = [_gf2_times(odd, v) for v in operator]
+            remaining >>= 1
+            if not remaining:
+                break
+        _crc_operators[len2] = operator
+    return _gf2_times(_crc_operators[len2], crc1) ^ crc2
+
+
+class StandInInterface(object):
+    """ Minimal stand-in for the QGIS interface used when QGIS isn't
+    available. Any attribute or call returns another stand-in, except
+    mainWindow() which returns a real widget when PyQt4 is available so
+    plugins can parent their actions and dialogs to it. """
+
+    def __init__(self, window=None):
+        self._window = window
+
+    def mainWindow(self):
+        return self._window or StandInInterface()
+
+    def __getattr__(self, name):
+        return StandInInterface(self._window)
+
+    def __call__(self, *args, **kwargs):
+        return StandInInterface(self._window)
+
+
+def load_iface(test_dir):
+    """ Return an interface for profiling a plugin: the QgisInterface stub
+    from the plugin tests (started through their get_qgis_app) or a
+    StandInInterface, and a description of which was used """
+    sys.path.insert(0, os.path.abspath(test_dir))
+    try:
+        import utilities
+        iface = utilities.get_qgis_app()[2]
+        if iface is not None:
+            return iface, 'QgisInterface stub'
+    except Exception:
+        pass
+    finally:
+        sys.path.pop(0)
+    window = None
+    try:
+        from PyQt4 import QtGui
+        app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+        window = QtGui.QMainWindow()
+        # keep a reference to the application for the life of the window
+        window.app = app
+    except Exception:
+        pass
+    return StandInInterface(window), 'stand-in interface (QGIS not available)'
+
+
+def memory_usage():
+    """ Return the resident memory of this process in KB, or None if it
+    can't be determined """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, ValueError, AttributeError, OSError):
+        pass
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on OS X
+        return usage // 1024 if sys.platform == 'darwin' else usage
+    except ImportError:
+        return None
+
+
+def import_node(name):
+    return {'name': name, 'time': 0.0, 'memory': 0, 'children': []}
+
+
+def profile_imports(phases):
+    """ Call each (label, function) in phases with __import__ instrumented.
+    Each function is passed a dict of the results of the previous phases.
+    Profiling stops at the first phase that raises.
+
+    :returns: a tree node for each phase that was run; each node has the
+        name, inclusive time, memory growth and children of an import that
+        loaded at least one new module
+    """
+    original = __builtin__.__import__
+    stack = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        node = import_node(name)
+        stack[-1]['children'].append(node)
+        stack.append(node)
+        memory = memory_usage()
+        start = time.time()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            node['time'] = time.time() - start
+            if memory is not None:
+                node['memory'] = memory_usage() - memory
+            node['name'] = import_label(name, globals, fromlist, level)
+            stack.pop()
+            if len(sys.modules) == loaded:
+                # already imported, nothing was loaded
+                stack[-1]['children'].pop()
+
+    roots = []
+    results = {}
+    __builtin__.__import__ = timed_import
+    try:
+        for (label, function) in phases:
+            root = import_node(label)
+            roots.append(root)
+            stack[:] = [root]
+            memory = memory_usage()
+            start = time.time()
+            try:
+                results[label] = function(results)
+            except Exception as oops:
+                root['error'] = '{0}: {1}'.format(type(oops).__name__, oops)
+            finally:
+                root['time'] = time.time() - start
+                if memory is not None:
+                    root['memory'] = memory_usage() - memory
+            if 'error' in root:
+                break
+    finally:
+        __builtin__.__import__ = original
+    return roots
+
+
+def import_label(name, globals, fromlist, level):
+    """ Return the absolute name of the module(s) an import statement
+    loaded, resolving relative imports against the importing module """
+    if level > 0 and globals and '__name__' in globals:
+        package = globals.get('__package__')
+        if not package:
+            package = globals['__name__']
+            if '__path__' not in globals:
+                package = package.rpartition('.')[0]
+        for i in range(level - 1):
+            package = package.rpartition('.')[0]
+        name = '.'.join(part for part in [package, name] if part)
+    submodules = [n for n in fromlist or ()
+                  if sys.modules.get('{0}.{1}'.format(name, n))]
+    if len(submodules) == 1:
+        return '{0}.{1}'.format(name, submodules[0])
+    elif submodules:
+        return '{0}.({1})'.format(name, ', '.join(submodules))
+    return name
+
+
+def print_import_node(node, depth, min_time):
+    click.echo("{0:9.1f} ms {1:6} KB  {2}{3}".format(
+        node['time'] * 1000, node['memory'], '  ' * depth, node['name']))
+    for child in sorted(node['children'], key=lambda n: n['time'], reverse=True):
+        if child['time'] >= min_time:
+            print_import_node(child, depth + 1, min_time)
+
+
+def flatten_imports(roots):
+    """ Return every import node below roots with its self time (the
+    time not spent in nested imports) in 'self' """
+    nodes = []
+    pending = [child for root in roots for child in root['children']]
+    while pending:
+        node = pending.pop()
+        node['self'] = node['time'] - sum(c['time'] for c in node['children'])
+        nodes.append(node)
+        pending.extend(node['children'])
+    return nodes
+
+
+def translatable_sources(cfg):
+    """ Return the Python and UI files of the plugin that may contain
+    translatable strings (compiled UI and resource modules are skipped) """
+    generated = set(compiled_ui(cfg) + compiled_resource(cfg))
+    sources = []
+    for option in ['python_files', 'main_dialog', 'compiled_ui_files']:
+        sources.extend(cfg_get(cfg, 'files', option).split())
+    for xdir in cfg_get(cfg, 'files', 'extra_dirs').split():
+        for (source, target) in tree_files(xdir, xdir, copy_rules(cfg, 'files')):
+            if source.endswith(('.py', '.ui')):
+                sources.append(source)
+    return [os.path.normpath(path) for path in sources
+            if path not in generated and os.path.isfile(path)]
+
+
+def extract_strings(path):
+    """ Return the translatable messages in a Python or UI file as
+    [context, source, comment, line, numerus] lists """
+    if path.endswith('.ui'):
+        return extract_ui_strings(path)
+    try:
+        with open(path) as src:
+            tree = ast.parse(src.read(), path)
+    except (SyntaxError, TypeError):
+        return []
+    messages = []
+
+    def literal(node):
+        if isinstance(node, ast.Str):
+            value = node.s
+            return value.decode('utf-8') if isinstance(value, str) else value
+        return None
+
+    def visit(node, context):
+        if isinstance(node, ast.ClassDef):
+            context = node.name
+        elif isinstance(node, ast.Call):
+            func = node.func
+            name = getattr(func, 'attr', getattr(func, 'id', None))
+            args = [literal(arg) for arg in node.args]
+            if name == 'tr' and args and args[0] is not None:
+                comment = args[1] if len(args) > 1 and args[1] else ''
+                messages.append([context or '@default', args[0], comment,
+                                 node.lineno, len(args) > 2])
+            elif (name == 'translate' and len(args) > 1 and
+                  args[0] is not None and args[1] is not None):
+                comment = args[2] if len(args) > 2 and args[2] else ''
+                messages.append([args[0], args[1], comment, node.lineno,
+                                 len(args) > 3])
+        for child in ast.iter_child_nodes(node):
+            visit(child, context)
+
+    visit(tree, None)
+    return messages
+
+
+def extract_ui_strings(path):
+    """ Return the translatable strings of a UI file; the context is the
+    class of the form """
+    messages = []
+    state = {'context': None, 'text': None}
+    parser = expat.ParserCreate()
+
+    def start(tag, attrs):
+        if tag in ('class', 'string'):
+            state['text'] = []
+            state['attrs'] = attrs
+            state['line'] = parser.CurrentLineNumber
+
+    def data(text):
+        if state['text'] is not None:
+            state['text'].append(text)
+
+    def end(tag):
+        if state['text'] is None:
+            return
+        text = u''.join(state['text'])
+        if tag == 'class' and state['context'] is None:
+            state['context'] = text
+        elif tag == 'string' and text and state['attrs'].get('notr') != 'true':
+            messages.append([None, text, state['attrs'].get('comment', ''),
+                             state['line'], False])
+        state['text'] = None
+
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = data
+    parser.EndElementHandler = end
+    with open(path, 'rb') as f:
+        parser.ParseFile(f)
+    return [[state['context'] or '@default'] + message[1:]
+            for message in messages]
+
+
+def ts_element(elem):
+    """ Serialize an element of a .ts file the way lupdate writes it """
+    attrs = ''.join(' {0}={1}'.format(key, quoteattr(value))
+                    for (key, value) in sorted(elem.items()))
+    inner = escape(elem.text or '') + ''.join(
+        ts_element(child) + escape(child.tail or '') for child in elem)
+    return u'<{0}{1}>{2}</{0}>'.format(elem.tag, attrs, inner)
+
+
+def merge_ts(ts_file, language, messages):
+    """ Merge the extracted (path, message) pairs into a .ts file in one
+    pass. Existing translations are kept, new messages are added as
+    unfinished and messages that are no longer used are dropped.
+
+    :returns: True if the file was written, False if it was up to date
+    """
+    existing = {}
+    if os.path.exists(ts_file):
+        root = ElementTree.parse(ts_file).getroot()
+        language = root.get('language', language)
+        for context in root.findall('context'):
+            name = context.findtext('name')
+            for message in context.findall('message'):
+                key = (name, message.findtext('source'),
+                       message.findtext('comment') or '')
+                existing[key] = message
+
+    ts_dir = os.path.dirname(ts_file)
+    contexts = {}
+    for (path, (context, source, comment, line, numerus)) in messages:
+        locations = contexts.setdefault(context, {}).setdefault(
+            (source, comment), [])
+        locations.append((os.path.relpath(path, ts_dir), line, numerus))
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<!DOCTYPE TS><TS version="2.0" language={0} sourcelanguage="en">'.format(
+                 quoteattr(language))]
+    for context in sorted(contexts):
+        lines.append('<context>')
+        lines.append('    <name>{0}</name>'.format(escape(context)))
+        for (source, comment) in sorted(contexts[context],
+                                        key=lambda k: contexts[context][k][0]):
+            locations = contexts[context][(source, comment)]
+            old = existing.get((context, source, comment))
+            numerus = any(n for (f, l, n) in locations)
+            lines.append('    <message{0}>'.format(
+                ' numerus="yes"' if numerus else ''))
+            for (filename, line, n) in locations:
+                lines.append('        <location filename={0} line="{1}"/>'.format(
+                    quoteattr(filename.replace(os.sep, '/')), line))
+            lines.append('        <source>{0}</source>'.format(escape(source)))
+            if comment:
+                lines.append('        <comment>{0}</comment>'.format(
+                    escape(comment)))
+            kept = [child for child in old
+                    if child.tag not in ('location', 'source', 'comment')] \
+                if old is not None else []
+            for child in kept:
+                lines.append('        ' + ts_element(child))
+            if not any(child.tag == 'translation' for child in kept):
+                lines.append(
+                    '        <translation type="unfinished">{0}</translation>'.format(
+                        '<numerusform></numerusform>' if numerus else ''))
+            lines.append('    </message>')
+        lines.append('</context>')
+    lines.append('</TS>')
+    content = u'\n'.join(lines).encode('utf-8') + b'\n'
+
+    try:
+        with open(ts_file, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    with atomic_write(ts_file) as f:
+        f.write(content)
+    return True
+
+
+class Job(object):
+    """ An external tool invocation run by run_jobs. After the run, status
+    is one of ok, failed, timeout or cancelled, and the exit status,
+    captured output and duration of the tool are recorded. A job with a
+    func runs it in-process instead of running cmd, which then only
+    describes the job; func returns the job's output. """
+
+    def __init__(self, name, cmd, cwd=None, timeout=None, func=None):
+        self.name = name
+        self.cmd = cmd
+        self.func = func
+        self.cwd = cwd
+        self.timeout = timeout
+        self.status = 'pending'
+        self.returncode = None
+        self.output = ''
+        self.duration = 0.0
+        self.process = None
+        self.terminated = False
+
+
+# Limits the number of external tools running at once across all jobs
+_job_slots = [threading.BoundedSemaphore(cpu_count())]
+
+
+def configure_jobs(cfg):
+    """ Set the global limit on concurrent tool runs from the jobs option
+    of the [build] section, if any """
+    jobs = cfg_get(cfg, 'build', 'jobs').strip()
+    if jobs:
+        _job_slots[0] = threading.BoundedSemaphore(max(1, int(jobs)))
+
+
+def tool_timeout(cfg):
+    """ Return the tool_timeout option of the [build] section in seconds,
+    or None if no timeout is set """
+    timeout = cfg_get(cfg, 'build', 'tool_timeout').strip()
+    return float(timeout) if timeout else None
+
+
+def run_jobs(jobs):
+    """ Run the jobs concurrently, with no more tools running at once
+    than the global limit allows. Output is captured per job. When a job
+    fails or times out, jobs that haven't started are cancelled and the
+    others are terminated.
+
+    :returns: True if all jobs succeeded
+    """
+    lock = threading.Lock()
+    cancelled = threading.Event()
+    slots = _job_slots[0]
+
+    def cancel():
+        with lock:
+            cancelled.set()
+            for job in jobs:
+                if job.process and job.process.poll() is None:
+                    job.terminated = True
+                    stop_process(job.process)
+
+    def run(job):
+        with slots:
+            start = time.time()
+            if job.func:
+                run_func(job, start)
+                return
+            with lock:
+                if cancelled.is_set():
+                    job.status = 'cancelled'
+                    return
+                try:
+                    job.process = subprocess.Popen(
+                        job.cmd, cwd=job.cwd, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, close_fds=os.name != 'nt',
+                        preexec_fn=os.setsid if os.name != 'nt' else None)
+                except OSError as oops:
+                    job.output = '{0}: {1}'.format(job.cmd[0], oops.strerror)
+                    job.status = 'failed'
+            if job.status == 'failed':
+                cancel()
+                return
+            timed_out = []
+            timer = None
+            if job.timeout:
+                def expire():
+                    with lock:
+                        if job.terminated:
+                            return
+                        timed_out.append(True)
+                        job.terminated = True
+                        stop_process(job.process)
+                timer = threading.Timer(job.timeout, expire)
+                timer.start()
+            job.output = job.process.communicate()[0]
+            if timer:
+                timer.cancel()
+            job.returncode = job.process.returncode
+            job.duration = time.time() - start
+            if timed_out:
+                job.status = 'timeout'
+            elif job.terminated:
+                job.status = 'cancelled'
+            elif job.returncode == 0:
+                job.status = 'ok'
+            else:
+                job.status = 'failed'
+            if job.status in ('failed', 'timeout'):
+                cancel()
+
+    def run_func(job, start):
+        # In-process jobs can't be stopped, only cancelled before they start
+        if cancelled.is_set():
+            job.status = 'cancelled'
+            return
+        try:
+            job.output = job.func() or ''
+            job.returncode = 0
+            job.status = 'ok'
+        except (EnvironmentError, SyntaxError, ValueError) as oops:
+            job.output = '{0}: {1}'.format(job.name, oops)
+            job.returncode = 1
+            job.status = 'failed'
+        except Exception:
+            # a bug rather than a bad input file; keep the traceback
+            job.output = '{0}: {1}'.format(job.name, traceback.format_exc())
+            job.returncode = 1
+            job.status = 'failed'
+        job.duration = time.time() - start
+        if job.status == 'failed':
+            cancel()
+
+    threads = [threading.Thread(target=run, args=(job,)) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all(job.status == 'ok' for job in jobs)
+
+
+def stop_process(process):
+    """ Terminate a tool started by run_jobs, along with any processes it
+    started itself (which would otherwise keep its output pipe open) """
+    try:
+        if os.name == 'nt':
+            process.terminate()
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def report_jobs(jobs):
+    """ Print the captured output of each job and any failures """
+    for job in jobs:
+        if job.output:
+            click.echo(job.output.rstrip())
+        if job.status == 'timeout':
+            click.secho("{0} timed out after {1:.1f}s".format(
+                job.name, job.duration), fg='red')
+        elif job.status == 'failed':
+            click.secho("{0} failed (exit status {1}) after {2:.1f}s".format(
+                job.name, job.returncode, job.duration), fg='red')
+        elif job.status == 'cancelled':
+            click.secho("{0} was cancelled".format(job.name), fg='yellow')
+
+
+def run_tools(jobs):
+    """ Run the jobs, print their output and exit if any failed """
+    ok = run_jobs(jobs)
+    report_jobs(jobs)
+    if not ok:
+        sys.exit(1)
+
+
+def run_tool(job):
+    """ Run a single job, print its output and exit if it failed """
+    run_tools([job])
+
+
+def start_metrics(command):
+    """ Start collecting step metrics for a run of command """
+    _metrics['command'] = command
+    _metrics['started'] = time.time()
+    _metrics['db'] = os.path.abspath(os.path.join(MANIFEST_DIR, METRICS_DB))
+    _metrics['steps'] = []
+
+
+def record_step(name, seconds, files=0, bytes=0, hits=0, misses=0):
+    """ Record the time a step of the current command took, the files and
+    bytes it handled and how many of them were up to date (hits) or had
+    to be rebuilt or copied (misses) """
+    _metrics['steps'].append({'name': name, 'seconds': seconds,
+                              'files': files, 'bytes': bytes, 'hits': hits,
+                              'misses': misses})
+
+
+def open_metrics(path):
+    """ Open the metrics database at path, creating its tables if needed """
+    db = sqlite3.connect(path, timeout=10)
+    db.execute("""CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY, command TEXT, started REAL, seconds REAL)""")
+    db.execute("""CREATE TABLE IF NOT EXISTS steps (
+        run INTEGER, name TEXT, seconds REAL, files INTEGER, bytes INTEGER,
+        hits INTEGER, misses INTEGER)""")
+    return db
+
+
+def save_metrics():
+    """ Store the steps recorded for the current command in the metrics
+    database. Runs that recorded no steps (and runs without sqlite3) are
+    not stored. """
+    if not _metrics['steps'] or sqlite3 is None:
+        return
+    path = _metrics['db']
+    try:
+        make_dirs(os.path.dirname(path))
+        db = open_metrics(path)
+        try:
+            with db:
+                run = db.execute(
+                    "INSERT INTO runs (command, started, seconds) VALUES (?, ?, ?)",
+                    (_metrics['command'], _metrics['started'],
+                     time.time() - _metrics['started'])).lastrowid
+                db.executemany(
+                    "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(run, step['name'], step['seconds'], step['files'],
+                      step['bytes'], step['hits'], step['misses'])
+                     for step in _metrics['steps']])
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error) as oops:
+        click.secho("Metrics were not saved: {0}".format(oops), fg='yellow')
+    _metrics['steps'] = []
+
+
+def read_metrics(command=None, runs=100):
+    """ Return the most recent runs in the metrics database, oldest first,
+    as dicts with the command, start time, duration and steps """
+    path = os.path.join(MANIFEST_DIR, METRICS_DB)
+    if sqlite3 is None or not os.path.exists(path):
+        return []
+    db = open_metrics(path)
+    try:
+        query = "SELECT id, command, started, seconds FROM runs"
+        args = ()
+        if command:
+            query += " WHERE command = ?"
+            args = (command,)
+        rows = db.execute(query + " ORDER BY id DESC LIMIT ?",
+                          args + (runs,)).fetchall()
+        history = [{'id': row[0], 'command': row[1], 'started': row[2],
+                    'seconds': row[3], 'steps': []} for row in reversed(rows)]
+        by_id = dict((run['id'], run) for run in history)
+        if history:
+            for row in db.execute(
+                    "SELECT run, name, seconds, files, bytes, hits, misses "
+                    "FROM steps WHERE run >= ? ORDER BY rowid",
+                    (history[0]['id'],)):
+                if row[0] in by_id:
+                    by_id[row[0]]['steps'].append(
+                        {'name': row[1], 'seconds': row[2], 'files': row[3],
+                         'bytes': row[4], 'hits': row[5], 'misses': row[6]})
+    finally:
+        db.close()
+    return history
+
+
+def percentile(values, pct):
+    """ Return the nearest-rank percentile of values """
+    ordered = sorted(values)
+    rank = max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return ordered[rank]
+
+
+def regression(times, baseline=10, threshold=1.5):
+    """ Compare the last of a series of times with the median of up to
+    baseline times before it.
+
+    :returns: (last, median) if the last time is more than threshold
+        times the median (and slower by at least 50ms), else (None, None)
+    """
+    previous = times[-baseline - 1:-1]
+    if len(previous) < 3:
+        return (None, None)
+    median = percentile(previous, 50)
+    last = times[-1]
+    if last > median * threshold and last - median >= 0.05:
+        return (last, median)
+    return (None, None)
+
+
+def check_sources(cfg):
+    """ Return the Python files of the plugin to check: python_files,
+    main_dialog and the modules in extra_dirs, without compiled UI and
+    resource modules """
+    generated = set(os.path.normpath(path)
+                    for path in compiled_ui(cfg) + compiled_resource(cfg))
+    sources = []
+    for option in ['python_files', 'main_dialog']:
+        sources.extend(cfg_get(cfg, 'files', option).split())
+    for xdir in cfg_get(cfg, 'files', 'extra_dirs').split():
+        sources.extend(source for (source, target) in
+                       tree_files(xdir, xdir, copy_rules(cfg, 'files')))
+    sources = [os.path.normpath(path) for path in sources
+               if path.endswith('.py')]
+    return [path for path in sources
+            if path not in generated and os.path.isfile(path)]
+
+
+def lint_tools():
+    """ Return the names and versions of the installed checkers """
+    tools = []
+    try:
+        import pyflakes
+        tools.append('pyflakes {0}'.format(pyflakes.__version__))
+    except ImportError:
+        pass
+    pep8 = import_pep8()
+    if pep8:
+        tools.append('{0} {1}'.format(pep8.__name__, pep8.__version__))
+    return tools
+
+
+def import_pep8():
+    """ Return the pep8 module (or pycodestyle, its new name), or None """
+    try:
+        import pep8
+    except ImportError:
+        try:
+            import pycodestyle as pep8
+        except ImportError:
+            return None
+    return pep8
+
+
+def lint_file(task):
+    """ Check one file with pyflakes and pep8 in a check worker process.
+
+    :returns: (path, problems), where problems are 'line:column: message'
+        strings sorted by line
+    """
+    (path, ignore, max_line_length) = task
+    problems = []
+    try:
+        from pyflakes import api, reporter
+        out = StringIO()
+        api.checkPath(path, reporter.Reporter(out, out))
+        prefix = path + ':'
+        problems.extend(line[len(prefix):] for line in out.getvalue().splitlines()
+                        if line.startswith(prefix))
+    except ImportError:
+        pass
+    pep8 = import_pep8()
+    if pep8:
+        class Report(pep8.BaseReport):
+            def error(self, line_number, offset, text, check):
+                code = super(Report, self).error(line_number, offset, text, check)
+                if code:
+                    problems.append('{0}:{1}: {2}'.format(
+                        line_number, offset + 1, text))
+                return code
+        pep8.StyleGuide(reporter=Report, ignore=ignore,
+                        max_line_length=max_line_length).check_files([path])
+
+    def line_number(problem):
+        number = problem.split(':', 1)[0]
+        return int(number) if number.isdigit() else 0
+    return (path, sorted(problems, key=line_number))
+
+
+def run_checks(cfg, jobs=0):
+    """ Check the plugin sources, reusing the cached results of files whose
+    content hasn't changed. Files whose size and modification time match
+    the cache aren't read at all; changed files are checked across a pool
+    of processes.
+
+    :returns: the problems found in each file, keyed by path, the number
+        of files checked and the number of cached results used, or None if
+        no checkers are installed
+    """
+    tools = lint_tools()
+    if not tools:
+        return None
+    start = time.time()
+    ignore = [code.strip() for code in
+              cfg_get(cfg, 'check', 'pep8_ignore', PEP8_IGNORE).split(',')
+              if code.strip()]
+    max_line_length = int(cfg_get(cfg, 'check', 'max_line_length', '79'))
+    key = ' '.join(tools + [','.join(ignore), str(max_line_length)])
+    mode = 'git' if change_detection(cfg) == 'git' else 'hash'
+    with locked(lock_path('check')):
+        cache = read_manifest('check')
+        results = {}
+        entries = {}
+        stale = []
+        changed = []
+        for path in check_sources(cfg):
+            st = os.stat(path)
+            entry = cache.get(path, {})
+            if entry.get('key') == key and entry.get('stat') == [st.st_size, st.st_mtime]:
+                results[path] = entry['problems']
+                entries[path] = entry
+            else:
+                changed.append((path, st))
+        identities = file_identities([item[0] for item in changed], mode)
+        for (path, st) in changed:
+            entry = cache.get(path, {})
+            identity = identities[path]
+            if entry.get('key') == key and entry.get('id') == identity:
+                results[path] = entry['problems']
+                entries[path] = dict(entry, stat=[st.st_size, st.st_mtime])
+                continue
+            stale.append(path)
+            entries[path] = {'key': key, 'id': identity,
+                             'stat': [st.st_size, st.st_mtime]}
+        if stale:
+            tasks = [(path, ignore, max_line_length) for path in stale]
+            pool = Pool(min(jobs or cpu_count(), len(stale)))
+            try:
+                for (path, problems) in pool.imap_unordered(lint_file, tasks):
+                    results[path] = problems
+                    entries[path]['problems'] = problems
+            finally:
+                pool.close()
+                pool.join()
+        if entries != cache:
+            write_manifest(entries, 'check')
+    record_step('check', time.time() - start, len(results), 0,
+                len(results) - len(stale), len(stale))
+    return results, len(stale), len(results) - len(stale)
+
+
+def print_checks(cfg, jobs=0):
+    """ Run the checks and print the problems found.
+
+    :returns: True if no problems were found
+    """
+    checked = run_checks(cfg, jobs)
+    if checked is None:
+        click.secho("Neither pyflakes nor pep8 is installed---nothing was checked",
+                    fg='yellow')
+        return True
+    (results, count, cached) = checked
+    total = 0
+    for path in sorted(results):
+        for problem in results[path]:
+            click.echo("{0}:{1}".format(path, problem))
+            total += 1
+    click.secho("Checked {0} files ({1} unchanged): {2} problems".format(
+        count + cached, cached, total), fg='red' if total else 'green')
+    return total == 0
+
+
+def check_gate(cfg, check=None):
+    """ Run the checks before a deploy or zip if check is True, or if it
+    is None and the config sets gate in the [check] section.
+
+    :returns: False if the checks found problems
+    """
+    if check is None:
+        check = cfg_get(cfg, 'check', 'gate').strip().lower() in (
+            '1', 'yes', 'true', 'on')
+    if not check:
+        return True
+    if print_checks(cfg):
+        return True
+    click.secho("Fix the problems or use --no-check to skip checking", fg='red')
+    return False
+
+
+# .qm file magic number and section tags, as written by Qt 4 lrelease
+QM_MAGIC = struct.pack('16B', 0x3c, 0xb8, 0x64, 0x18, 0xca, 0xef, 0x9c, 0x95,
+                       0xcd, 0x21, 0x1c, 0xbf, 0x60, 0xa1, 0xbd, 0xdd)
+QM_HASHES = 0x42
+QM_MESSAGES = 0x69
+QM_NUMERUS_RULES = 0x88
+# message record tags
+QM_TAG_END = 1
+QM_TAG_TRANSLATION = 3
+QM_TAG_SOURCE_TEXT = 6
+QM_TAG_CONTEXT = 7
+QM_TAG_COMMENT = 8
+
+# Plural form rules (the numerus rules of Qt's lrelease), by language code.
+# Each rule is a condition on n; the first one that holds picks the form.
+(_EQ, _LT, _LEQ, _BETWEEN, _NOT, _MOD_10, _MOD_100, _LEAD_1000,
+ _AND, _OR, _NEWRULE) = (0x01, 0x02, 0x03, 0x04, 0x08, 0x10, 0x20, 0x40,
+                         0xfd, 0xfe, 0xff)
+_NEQ = _NOT | _EQ
+_GEQ = _NOT | _LT
+_NOT_BETWEEN = _NOT | _BETWEEN
+NUMERUS_RULES = {}
+for (rules, languages) in [
+        ([], 'bo dz fa hu id ja jv ko ms my su th tr tt vi yo za zh'),
+        ([_EQ, 1], 'aa ab af am as ay az ba bg bh bn co da de el en eo es et '
+         'eu fi fo fy gl gu ha he hi ia ie it ka kk kl km kn ks ku kw ky la '
+         'lb ln lo mg ml mn mr nb ne nl nn no oc or pa ps pt qu rm rn rw sd '
+         'si sn so sq ss st sv sw ta te tg tk tn to ts tw ug ur uz vo xh yi '
+         'zu'),
+        ([_LEQ, 1], 'br fr hy pt_BR ti wa'),
+        ([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11, _NEWRULE, _NEQ, 0],
+         'lv'),
+        ([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11], 'is'),
+        ([_EQ, 1, _NEWRULE, _EQ, 2], 'dv ga gd gv iu mi sa se sm'),
+        ([_EQ, 1, _NEWRULE, _BETWEEN, 2, 4], 'cs sk'),
+        ([_MOD_10 | _EQ, 1, _NEWRULE, _MOD_10 | _EQ, 2], 'mk'),
+        ([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11, _NEWRULE,
+          _MOD_10 | _NEQ, 0, _AND, _MOD_100 | _NOT_BETWEEN, 10, 19], 'lt'),
+        ([_MOD_10 | _EQ, 1, _AND, _MOD_100 | _NEQ, 11, _NEWRULE,
+          _MOD_10 | _BETWEEN, 2, 4, _AND, _MOD_100 | _NOT_BETWEEN, 10, 19],
+         'be bs hr ru sh sr uk'),
+        ([_EQ, 1, _NEWRULE, _MOD_10 | _BETWEEN, 2, 4, _AND,
+          _MOD_100 | _NOT_BETWEEN, 10, 19], 'pl'),
+        ([_EQ, 1, _NEWRULE, _EQ, 0, _OR, _MOD_100 | _BETWEEN, 1, 19], 'mo ro'),
+        ([_MOD_100 | _EQ, 1, _NEWRULE, _MOD_100 | _EQ, 2, _NEWRULE,
+          _MOD_100 | _BETWEEN, 3, 4], 'sl'),
+        ([_EQ, 1, _NEWRULE, _EQ, 0, _OR, _MOD_100 | _BETWEEN, 1, 10, _NEWRULE,
+          _MOD_100 | _BETWEEN, 11, 19], 'mt'),
+        ([_EQ, 0, _NEWRULE, _EQ, 1, _NEWRULE, _BETWEEN, 2, 5, _NEWRULE, _EQ, 6],
+         'cy'),
+        ([_EQ, 0, _NEWRULE, _EQ, 1, _NEWRULE, _EQ, 2, _NEWRULE,
+          _MOD_100 | _BETWEEN, 3, 10, _NEWRULE, _MOD_100 | _GEQ, 11], 'ar'),
+        ([_LEQ, 1, _NEWRULE, _MOD_10 | _EQ, 4, _OR, _MOD_10 | _EQ, 6, _OR,
+          _MOD_10 | _EQ, 9], 'fil tl'),
+        ([_EQ, 1, _NEWRULE, _LEAD_1000 | _EQ, 11, _NEWRULE], 'ca')]:
+    for language in languages.split():
+        NUMERUS_RULES[language] = struct.pack('{0}B'.format(len(rules)), *rules)
+
+
+def compile_translations(pairs, jobs=0):
+    """ Compile (ts, qm) file pairs with the built-in compiler, across a
+    pool of processes when there is more than one.
+
+    :returns: a (ts, qm, message count, error) tuple for each pair, where
+        error is None or the reason the file couldn't be compiled
+    """
+    if len(pairs) < 2:
+        return [compile_ts(pair) for pair in pairs]
+    pool = Pool(min(jobs or cpu_count(), len(pairs)))
+    try:
+        return pool.map(compile_ts, pairs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def compile_ts(pair):
+    """ Compile a .ts file to a .qm file.
+
+    :returns: (ts, qm, message count, error)
+    """
+    (ts, qm) = pair
+    try:
+        (language, messages) = read_ts(ts)
+        data = qm_data(language, messages)
+        with atomic_write(qm) as f:
+            f.write(data[0])
+        return (ts, qm, data[1], None)
+    except (IOError, OSError) as oops:
+        return (ts, qm, 0, oops.strerror or str(oops))
+    except SyntaxError as oops:
+        # ElementTree.ParseError
+        return (ts, qm, 0, str(oops))
+
+
+def read_ts(ts):
+    """ Read the messages of a .ts file with an incremental parser,
+    discarding each message once it has been read.
+
+    :returns: the language of the file and a list of (context, source,
+        comment, translations, type, utf8) tuples
+    """
+    language = ''
+    codec_utf8 = False
+    context = ''
+    messages = []
+    for (event, elem) in ElementTree.iterparse(ts, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'TS':
+                language = elem.get('language', '')
+            continue
+        if elem.tag == 'defaultcodec':
+            codec_utf8 = (elem.text or '').strip().lower() in ('utf-8', 'utf8')
+        elif elem.tag == 'name':
+            context = elem.text or ''
+        elif elem.tag == 'message':
+            translation = elem.find('translation')
+            if translation is None:
+                translations = ['']
+                kind = 'unfinished'
+            else:
+                kind = translation.get('type')
+                if elem.get('numerus') == 'yes':
+                    forms = translation.findall('numerusform')
+                    translations = [ts_variants(form) for form in forms] or ['']
+                else:
+                    translations = [ts_variants(translation)]
+            messages.append((context, elem.findtext('source') or '',
+                             elem.findtext('comment') or '', translations,
+                             kind, codec_utf8 or elem.get('utf8') == 'true'))
+            elem.clear()
+        elif elem.tag == 'context':
+            elem.clear()
+    return language, messages
+
+
+def ts_variants(elem):
+    """ Return the text of a translation (or numerus form), joining length
+    variants with U+009C the way Qt does """
+    if elem.get('variants') == 'yes':
+        return u'\x9c'.join(variant.text or u''
+                            for variant in elem.findall('lengthvariant'))
+    return elem.text or u''
+
+
+def qm_data(language, messages):
+    """ Build the content of a .qm file from the messages of a .ts file,
+    selecting and laying out messages the way lrelease does by default:
+    obsolete messages and unfinished messages without a translation are
+    dropped, comments are only kept when they tell messages apart, and
+    messages are sorted by context, source text and comment with a hash
+    table of (hash, offset) pairs sorted by hash.
+
+    :returns: the .qm content and the number of messages in it
+    """
+    uncommented = set((context, source) for (context, source, comment,
+                                             translations, kind, utf8)
+                      in messages if not comment)
+    entries = {}
+    for (context, source, comment, translations, kind, utf8) in messages:
+        if kind in ('obsolete', 'vanished'):
+            continue
+        if kind == 'unfinished' and not translations[0]:
+            continue
+        key = tuple(qm_bytes(text, utf8) for text in (context, source, comment))
+        if comment and context and (context, source) not in uncommented:
+            stripped = (key[0], key[1], '')
+            if stripped not in entries:
+                entries[stripped] = translations
+                continue
+        if key not in entries:
+            entries[key] = translations
+
+    offsets = []
+    chunks = []
+    position = 0
+    for key in sorted(entries):
+        (context, source, comment) = key
+        record = []
+        for translation in entries[key]:
+            text = translation.encode('utf-16-be')
+            record.append(struct.pack('>BI', QM_TAG_TRANSLATION, len(text)) + text)
+        for (tag, value) in ((QM_TAG_COMMENT, comment),
+                             (QM_TAG_SOURCE_TEXT, source),
+                             (QM_TAG_CONTEXT, context)):
+            record.append(struct.pack('>BI', tag, len(value)) + value)
+        record.append(struct.pack('>B', QM_TAG_END))
+        record = ''.join(record)
+        offsets.append((elf_hash(source + comment), position))
+        chunks.append(record)
+        position += len(record)
+
+    sections = [QM_MAGIC]
+    if offsets:
+        table = ''.join(struct.pack('>II', h, o) for (h, o) in sorted(offsets))
+        body = ''.join(chunks)
+        sections.append(struct.pack('>BI', QM_HASHES, len(table)) + table)
+        sections.append(struct.pack('>BI', QM_MESSAGES, len(body)) + body)
+    rules = NUMERUS_RULES.get(language, NUMERUS_RULES.get(
+        language.split('_')[0]))
+    if rules:
+        sections.append(struct.pack('>BI', QM_NUMERUS_RULES, len(rules)) + rules)
+    return ''.join(sections), len(entries)
+
+
+def qm_bytes(text, utf8=False):
+    """ Encode the context, source text or comment of a message the way
+    tr() passes it to Qt: Latin-1, or UTF-8 for messages marked as UTF-8
+    (or that can't be encoded as Latin-1) """
+    if not utf8:
+        try:
+            return text.encode('latin-1')
+        except UnicodeError:
+            pass
+    return text.encode('utf-8')
+
+
+def elf_hash(data):
+    """ Return the ELF hash Qt uses to look up messages in .qm files """
+    h = 0
+    for char in data:
+        if char == '\0':
+            break
+        h = ((h << 4) + ord(char)) & 0xffffffff
+        g = h & 0xf0000000
+        if g:
+            h ^= g >> 24
+        h &= ~g & 0xffffffff
+    return h or 1
+
+
+# The command line shown for jobs run by the built-in resource compiler
+BUILTIN_RCC = 'builtin-rcc'
+# Resource tree node flags and the minimum space saving (in percent) for
+# an asset to be stored compressed, as in rcc and pyrcc4
+RCC_COMPRESSED = 0x01
+RCC_DIRECTORY = 0x02
+RCC_COMPRESS_THRESHOLD = 70
+# QLocale::C, the locale of resources without a lang attribute
+RCC_LANGUAGE_C = 1
+
+
+def compile_qrc(qrc, output, binary=False):
+    """ Compile a .qrc file to a Python module in the format pyrcc4 writes
+    or, with binary, to a .rcc file like rcc -binary. Assets are
+    compressed concurrently and their compressed blobs cached by content
+    hash, so only new or changed assets are compressed again.
+
+    :returns: the output of the compiler (always empty)
+    """
+    (data, names, tree) = rcc_sections(read_qrc(qrc), rcc_cache_dir(qrc))
+    with open(output, 'wb') as f:
+        if binary:
+            f.write('qres' + struct.pack('>IIII', 1,
+                                         20 + len(data) + len(names), 20,
+                                         20 + len(data)))
+            f.write(data)
+            f.write(names)
+            f.write(tree)
+        else:
+            f.write(Template(rcc_module_template()).substitute(
+                Source=qrc, Data=rcc_literal(data), Name=rcc_literal(names),
+                Struct=rcc_literal(tree)))
+    return ''
+
+
+def read_qrc(qrc):
+    """ Return the files listed in a .qrc file as (resource path, file,
+    compression level, threshold) tuples. Directories are listed file by
+    file. """
+    base = os.path.dirname(qrc)
+    resources = []
+    for qresource in ElementTree.parse(qrc).getroot().iter('qresource'):
+        if qresource.get('lang'):
+            raise ValueError("language specific resources need rcc_tool: yes")
+        prefix = qresource.get('prefix', '')
+        for node in qresource.iter('file'):
+            if not node.text or not node.text.strip():
+                continue
+            path = os.path.join(base, node.text.strip())
+            name = '/'.join([prefix, node.get('alias') or node.text.strip()])
+            level = int(node.get('compress', -1))
+            threshold = int(node.get('threshold', RCC_COMPRESS_THRESHOLD))
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for fname in sorted(filenames):
+                        full = os.path.join(dirpath, fname)
+                        rel = os.path.relpath(full, path).replace(os.sep, '/')
+                        resources.append(('/'.join([name, rel]), full, level,
+                                          threshold))
+            elif os.path.isfile(path):
+                resources.append((name, path, level, threshold))
+            else:
+                raise IOError(errno.ENOENT, "Cannot find file", path)
+    return resources
+
+
+def rcc_cache_dir(qrc):
+    """ Return the directory caching the compressed assets of a .qrc file """
+    key = hashlib.sha1(os.path.normpath(qrc)).hexdigest()[:16]
+    return os.path.join(MANIFEST_DIR, 'rcc', key)
+
+
+def rcc_sections(resources, cache_dir):
+    """ Lay out resources the way rcc does: a data section with the
+    (possibly compressed) content of each file, a names section with each
+    distinct name and its hash, and the tree of 14 byte nodes, breadth
+    first, with the children of each directory sorted by name hash.
+
+    :returns: the data, names and tree sections
+    """
+    root = {'name': u'', 'children': {}}
+    files = []
+    for (name, path, level, threshold) in resources:
+        node = root
+        parts = [part for part in name.split('/') if part not in ('', '.')]
+        for (i, part) in enumerate(parts):
+            part = part if isinstance(part, unicode) else part.decode(
+                sys.getfilesystemencoding() or 'utf-8')
+            if part not in node['children']:
+                node['children'][part] = {'name': part, 'children': {}}
+                if i == len(parts) - 1:
+                    node['children'][part]['task'] = (path, level, threshold,
+                                                     cache_dir)
+                    files.append(node['children'][part])
+            node = node['children'][part]
+
+    blobs = rcc_blobs([entry['task'] for entry in files], cache_dir)
+    for (node, blob) in izip(files, blobs):
+        node['blob'] = blob
+
+    def children(node):
+        return sorted(node['children'].values(),
+                      key=lambda child: (qt_hash(child['name']), child['name']))
+
+    # Child offsets, then the nodes in the same (stack) order
+    pending = [root]
+    offset = 1
+    while pending:
+        node = pending.pop()
+        node['offset'] = offset
+        for child in children(node):
+            offset += 1
+            if 'task' not in child:
+                pending.append(child)
+    order = [root]
+    pending = [root]
+    while pending:
+        for child in children(pending.pop()):
+            order.append(child)
+            if 'task' not in child:
+                pending.append(child)
+
+    data = []
+    data_size = 0
+    names = []
+    name_offsets = {}
+    names_size = 0
+    tree = []
+    for node in order:
+        name = node['name']
+        if node is not root and name not in name_offsets:
+            text = name.encode('utf-16-be')
+            name_offsets[name] = names_size
+            names.append(struct.pack('>HI', len(text) // 2, qt_hash(name)) +
+                         text)
+            names_size += len(names[-1])
+        name_offset = name_offsets.get(name, 0)
+        if 'task' in node:
+            (flags, payload) = node['blob']
+            tree.append(struct.pack('>IHHHI', name_offset, flags, 0,
+                                    RCC_LANGUAGE_C, data_size))
+            data.append(struct.pack('>I', len(payload)))
+            data.append(payload)
+            data_size += 4 + len(payload)
+        else:
+            tree.append(struct.pack('>IHII', name_offset, RCC_DIRECTORY,
+                                    len(node['children']), node['offset']))
+    return ''.join(data), ''.join(names), ''.join(tree)
+
+
+def rcc_blobs(tasks, cache_dir):
+    """ Return the (flags, payload) of each asset, compressing them on a
+    pool of threads (zlib releases the GIL). Cached blobs of assets that
+    are no longer used are removed. """
+    make_dirs(cache_dir)
+    if len(tasks) > 1:
+        pool = ThreadPool(min(cpu_count(), len(tasks)))
+        try:
+            results = pool.map(rcc_blob, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [rcc_blob(task) for task in tasks]
+    used = set(key for (key, flags, payload) in results)
+    for fname in os.listdir(cache_dir):
+        if fname not in used and not fname.startswith('.'):
+            try:
+                os.remove(os.path.join(cache_dir, fname))
+            except OSError:
+                pass
+    return [(flags, payload) for (key, flags, payload) in results]
+
+
+def rcc_blob(task):
+    """ Return the cache key, flags and payload of an asset. The asset is
+    stored compressed (like qCompress: the size followed by the zlib
+    stream) if that saves at least threshold percent. The cache holds the
+    compressed payload, or nothing if the asset is stored as it is.
+
+    :returns: (key, flags, payload)
+    """
+    (path, level, threshold, cache_dir) = task
+    with open(path, 'rb') as f:
+        content = f.read()
+    if level == 0 or not content:
+        return (None, 0, content)
+    key = '{0}-{1}-{2}'.format(hashlib.sha1(content).hexdigest(), level,
+                               threshold)
+    cached = os.path.join(cache_dir, key)
+    try:
+        with open(cached, 'rb') as f:
+            payload = f.read()
+    except IOError:
+        payload = struct.pack('>I', len(content)) + zlib.compress(
+            content, max(-1, min(level, 9)))
+        saving = int(100.0 * (len(content) - len(payload)) / len(content))
+        if saving < threshold:
+            payload = ''
+        with atomic_write(cached) as f:
+            f.write(payload)
+    if payload:
+        return (key, RCC_COMPRESSED, payload)
+    return (key, 0, content)
+
+
+def qt_hash(name):
+    """ Return the hash Qt 4 uses to look up names in compiled resources """
+    h = 0
+    text = name.encode('utf-16-be')
+    for unit in struct.unpack('>{0}H'.format(len(text) // 2), text):
+        h = (h << 4) + unit
+        h ^= (h & 0xf0000000) >> 23
+        h &= 0x0fffffff
+    return h
+
+
+def rcc_literal(data):
+    """ Format data as the lines of a string literal, as pyrcc4 does """
+    return ''.join('{0}\\\n'.format(''.join('\\x{0:02x}'.format(ord(char))
+                                           for char in data[i:i + 16]))
+                   for i in range(0, len(data), 16))
+
+
+def rcc_module_template():
+    """
+    :return: the template for a resource module compiled by compile_qrc
+    """
+    template = """# -*- coding: utf-8 -*-
+
+# Resource object code
+#
+# Created from $Source by pb_tool
+#
+# WARNING! All changes made in this file will be lost!
+
+from PyQt4 import QtCore
+
+qt_resource_data = "\\
+$Data"
+
+qt_resource_name = "\\
+$Name"
+
+qt_resource_struct = "\\
+$Struct"
+
+def qInitResources():
+    QtCore.qRegisterResourceData(0x01, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+def qCleanupResources():
+    QtCore.qUnregisterResourceData(0x01, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+qInitResources()
+"""
+    return template
@@ -0,0 +1,607 @@
+# coding=utf-8
+"""Tests for pb_tool: reload requests (run against the stand-in listener)
+and deploy planning."""
+
+import os
+import re
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import zlib
+import unittest
+import zipfile
+import ConfigParser
+
+from click.testing import CliRunner
+
+import pb_tool
+
+PLUGIN_CONFIG = """[plugin]
+name: TestPlugin
+
+[files]
+python_files: __init__.py
+main_dialog:
+compiled_ui_files:
+resource_files:
+extras: metadata.txt icon.png
+locales:
+
+[help]
+dir: help
+target: help
+
+[build]
+change_detection: hash
+"""
+
+RESOURCES = """<RCC>
+    <qresource prefix="/plugins/TestPlugin" >
+        <file>icon.png</file>
+    </qresource>
+</RCC>
+"""
+
+TRANSLATIONS = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE TS><TS version="2.0" language="af" sourcelanguage="en">
+<context>
+    <name>Dialog</name>
+    <message>
+        <source>Good morning</source>
+        <translation>Goeie more</translation>
+    </message>
+    <message>
+        <source>Open</source>
+        <comment>verb</comment>
+        <translation>Maak oop</translation>
+    </message>
+    <message>
+        <source>Open</source>
+        <comment>adjective</comment>
+        <translation>Oop</translation>
+    </message>
+    <message>
+        <source>Close</source>
+        <translation type="unfinished"></translation>
+    </message>
+    <message>
+        <source>Quit</source>
+        <translation type="obsolete">Verlaat</translation>
+    </message>
+</context>
+</TS>
+"""
+
+
+def plugin_config(name, port):
+    """ Return a config for the plugin name reloading through port """
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('plugin')
+    cfg.set('plugin', 'name', name)
+    cfg.add_section('deploy')
+    cfg.set('deploy', 'reload_port', str(port))
+    return cfg
+
+
+def free_port():
+    """ Return a local port nothing is listening on """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = pb_tool.StandInListener()
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def test_notify_reload(self):
+        reply = pb_tool.notify_reload('TestPlugin', self.listener.port)
+        self.assertEqual(reply, 'ok')
+        self.assertEqual(self.listener.requests, ['TestPlugin'])
+
+    def test_report_reload(self):
+        cfg = plugin_config('TestPlugin', self.listener.port)
+        self.assertTrue(pb_tool.report_reload(cfg))
+        self.assertEqual(self.listener.requests, ['TestPlugin'])
+
+    def test_unknown_request(self):
+        conn = socket.create_connection(('127.0.0.1', self.listener.port), 5)
+        try:
+            conn.sendall('restart TestPlugin\n')
+            reply = conn.makefile().readline().strip()
+        finally:
+            conn.close()
+        self.assertEqual(reply, 'error unknown request')
+        self.assertEqual(self.listener.requests, [])
+
+
+class TestNoListener(unittest.TestCase):
+
+    def test_notify_reload(self):
+        self.assertIsNone(pb_tool.notify_reload('TestPlugin', free_port()))
+
+    def test_report_reload(self):
+        cfg = plugin_config('TestPlugin', free_port())
+        self.assertFalse(pb_tool.report_reload(cfg))
+
+
+class ProjectTestCase(unittest.TestCase):
+    """ Runs each test in a fresh plugin project directory """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.home = os.environ.get('HOME')
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        # per-user state, such as deploy target locks, stays in the project
+        os.environ['HOME'] = self.root
+        os.mkdir('help')
+        for (name, content) in [('pb_tool.cfg', PLUGIN_CONFIG),
+                                ('__init__.py', 'def classFactory(iface):\n'
+                                 '    pass\n'),
+                                ('metadata.txt', '[general]\nname=TestPlugin\n'),
+                                ('icon.png', '\x89PNG\r\n\x1a\n' + 'x' * 100),
+                                ('resources.qrc', RESOURCES),
+                                (os.path.join('help', 'index.html'), '<p/>')]:
+            with open(name, 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+        shutil.rmtree(self.root)
+
+
+class TestDeployPlan(ProjectTestCase):
+
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        # index files as soon as they are hashed
+        self.racy_seconds = pb_tool.RACY_SECONDS
+        pb_tool.RACY_SECONDS = -60
+        self.plugins = os.path.join(self.root, 'plugins')
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        pb_tool.RACY_SECONDS = self.racy_seconds
+        ProjectTestCase.tearDown(self)
+
+    def run_cli(self, *args):
+        result = self.runner.invoke(pb_tool.cli, list(args))
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def planned_copies(self):
+        output = self.run_cli('deploy', '--plan', '-q', '-t', self.plugins)
+        return int(re.search(r'Copy to .*: (\d+) files', output).group(1))
+
+    def deployed_copies(self):
+        output = self.run_cli('deploy', '-q', '-t', self.plugins)
+        return int(re.search(r'Copied (\d+) files', output).group(1))
+
+    def test_plan_matches_deploy(self):
+        self.assertEqual(self.planned_copies(), 4)
+        self.assertEqual(self.deployed_copies(), 4)
+        # touched without changing their content
+        past = time.time() - 1000
+        for path in ['metadata.txt', 'icon.png']:
+            os.utime(path, (past, past))
+        # status hashes the touched files into the stat index
+        self.run_cli('status', '-t', self.plugins)
+        self.assertEqual(self.planned_copies(), 0)
+        self.assertEqual(self.deployed_copies(), 0)
+        with open('metadata.txt', 'ab') as f:
+            f.write('version=0.2\n')
+        self.assertEqual(self.planned_copies(), 1)
+        self.assertEqual(self.deployed_copies(), 1)
+
+
+class TestTargetLock(unittest.TestCase):
+
+    def test_shared_between_projects(self):
+        cwd = os.getcwd()
+        roots = [tempfile.mkdtemp() for i in range(2)]
+        plugin_dir = os.path.join(roots[0], 'plugins', 'TestPlugin')
+        try:
+            locks = []
+            for root in roots:
+                os.chdir(root)
+                locks.append(pb_tool.target_lock(plugin_dir))
+        finally:
+            os.chdir(cwd)
+            for root in roots:
+                shutil.rmtree(root)
+        self.assertEqual(locks[0], locks[1])
+        self.assertEqual(os.path.dirname(locks[0]),
+                         os.path.expanduser(pb_tool.USER_LOCK_DIR))
+        self.assertNotEqual(locks[0], pb_tool.target_lock(
+            os.path.join(roots[0], 'plugins', 'OtherPlugin')))
+
+
+class TestRemoveTree(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.plugins = os.path.join(self.root, 'plugins')
+        self.plugin_dir = os.path.join(self.plugins, 'TestPlugin')
+        os.makedirs(os.path.join(self.plugin_dir, 'help'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def wait_for_trash(self, parent):
+        """ Return the trash directories left in parent once the
+        background deletes have had a few seconds """
+        for i in range(50):
+            trash = [name for name in os.listdir(parent)
+                     if name.startswith(pb_tool.TRASH_PREFIX)]
+            if not trash:
+                break
+            time.sleep(0.1)
+        return trash
+
+    def test_trash_outside_plugins_dir(self):
+        pb_tool.remove_tree(self.plugin_dir)
+        self.assertEqual(os.listdir(self.plugins), [])
+        self.assertEqual(self.wait_for_trash(self.root), [])
+
+    def test_collect_trash(self):
+        for parent in [self.root, self.plugins]:
+            os.makedirs(os.path.join(parent, pb_tool.TRASH_PREFIX + 'left',
+                                     'TestPlugin'))
+        pb_tool.collect_trash([self.plugin_dir])
+        self.assertEqual(self.wait_for_trash(self.root), [])
+        self.assertEqual(self.wait_for_trash(self.plugins), [])
+
+
+class TestRunJobs(unittest.TestCase):
+
+    def test_func_error(self):
+        def broken():
+            return {}['missing']
+        jobs = [pb_tool.Job('broken', ['broken'], func=broken),
+                pb_tool.Job('sleep', [sys.executable, '-c',
+                                      'import time; time.sleep(5)'])]
+        self.assertFalse(pb_tool.run_jobs(jobs))
+        self.assertEqual(jobs[0].status, 'failed')
+        self.assertIn('KeyError', jobs[0].output)
+        self.assertEqual(jobs[1].status, 'cancelled')
+
+
+class TestCompileStatus(ProjectTestCase):
+
+    def test_rcc_loader(self):
+        with open('pb_tool.cfg', 'wb') as f:
+            f.write(PLUGIN_CONFIG.replace(
+                'resource_files:\n',
+                'resource_files: resources.qrc\nresource_mode: rcc\n'))
+        runner = CliRunner()
+        result = runner.invoke(pb_tool.cli, ['compile'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        cfg = pb_tool.get_config('pb_tool.cfg')
+        self.assertEqual(pb_tool.compile_status(cfg), [])
+        os.remove('resources_rc.py')
+        self.assertEqual(pb_tool.compile_status(cfg),
+                         [('resources_rc.py', 'resources.qrc')])
+        result = runner.invoke(pb_tool.cli, ['compile'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertTrue(os.path.exists('resources_rc.py'))
+        self.assertEqual(pb_tool.compile_status(cfg), [])
+
+
+def read_qm(data):
+    """ Parse .qm data into its sections, keyed by tag """
+    sections = {}
+    position = 16
+    while position < len(data):
+        (tag, length) = struct.unpack('>BI', data[position:position + 5])
+        sections[tag] = data[position + 5:position + 5 + length]
+        position += 5 + length
+    return sections
+
+
+def read_qm_message(messages, offset):
+    """ Parse the message record at offset into a dict of its fields """
+    fields = {}
+    while True:
+        tag = ord(messages[offset])
+        if tag == pb_tool.QM_TAG_END:
+            return fields
+        (length,) = struct.unpack('>I', messages[offset + 1:offset + 5])
+        fields[tag] = messages[offset + 5:offset + 5 + length]
+        offset += 5 + length
+
+
+class TestQm(ProjectTestCase):
+
+    def test_elf_hash(self):
+        self.assertEqual(
+            pb_tool.elf_hash('abcdefghijklmnopqrstuvwxyz1234567890'),
+            126631744)
+        self.assertEqual(pb_tool.elf_hash('Good morning'), 0x88f1a37)
+        # Qt never uses 0, and stops at a NUL
+        self.assertEqual(pb_tool.elf_hash(''), 1)
+        self.assertEqual(pb_tool.elf_hash('Good\0 morning'),
+                         pb_tool.elf_hash('Good'))
+
+    def test_compile_ts(self):
+        with open('af.ts', 'wb') as f:
+            f.write(TRANSLATIONS)
+        (ts, qm, count, error) = pb_tool.compile_ts(('af.ts', 'af.qm'))
+        self.assertIsNone(error)
+        # the unfinished and obsolete messages are dropped
+        self.assertEqual(count, 3)
+        with open('af.qm', 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:16], '<\xb8d\x18\xca\xef\x9c\x95'
+                                    '\xcd!\x1c\xbf`\xa1\xbd\xdd')
+        sections = read_qm(data)
+        self.assertEqual(sections[pb_tool.QM_NUMERUS_RULES], '\x01\x01')
+        table = sections[pb_tool.QM_HASHES]
+        pairs = [struct.unpack('>II', table[i:i + 8])
+                 for i in range(0, len(table), 8)]
+        self.assertEqual(pairs, sorted(pairs))
+        found = {}
+        for (digest, offset) in pairs:
+            fields = read_qm_message(sections[pb_tool.QM_MESSAGES], offset)
+            source = fields[pb_tool.QM_TAG_SOURCE_TEXT]
+            comment = fields[pb_tool.QM_TAG_COMMENT]
+            self.assertEqual(digest, pb_tool.elf_hash(source + comment))
+            self.assertEqual(fields[pb_tool.QM_TAG_CONTEXT], 'Dialog')
+            found[(source, comment)] = fields[
+                pb_tool.QM_TAG_TRANSLATION].decode('utf-16-be')
+        # as with lrelease, the first of the commented messages loses its
+        # comment, the others keep it to tell them apart
+        self.assertEqual(found, {('Good morning', ''): u'Goeie more',
+                                 ('Open', ''): u'Maak oop',
+                                 ('Open', 'adjective'): u'Oop'})
+
+
+class ResourceTree(object):
+    """ Reads the tree, names and data sections of compiled resources """
+
+    def __init__(self, tree, names, data):
+        self.tree = tree
+        self.names = names
+        self.data = data
+
+    def name(self, offset):
+        (length, digest) = struct.unpack('>HI', self.names[offset:offset + 6])
+        name = self.names[offset + 6:offset + 6 + 2 * length]
+        return name.decode('utf-16-be'), digest
+
+    def children(self, index):
+        """ Return the (name, hash, node index) of each child of a
+        directory node """
+        node = self.tree[14 * index:14 * index + 14]
+        (name, flags, count, first) = struct.unpack('>IHII', node)
+        assert flags & pb_tool.RCC_DIRECTORY
+        return [self.name(struct.unpack('>I', self.tree[14 * i:14 * i + 4])[0])
+                + (i,) for i in range(first, first + count)]
+
+    def find(self, path):
+        """ Return the flags and payload of the file at path """
+        index = 0
+        for part in path.strip('/').split('/'):
+            children = self.children(index)
+            self.check_children(children)
+            index = [i for (name, digest, i) in children if name == part][0]
+        (name, flags, country, language, offset) = struct.unpack(
+            '>IHHHI', self.tree[14 * index:14 * index + 14])
+        (size,) = struct.unpack('>I', self.data[offset:offset + 4])
+        return flags, self.data[offset + 4:offset + 4 + size]
+
+    @staticmethod
+    def check_children(children):
+        """ Qt looks children up by a binary search on their name hash """
+        digests = [digest for (name, digest, i) in children]
+        assert digests == sorted(digests)
+        assert digests == [pb_tool.qt_hash(name)
+                           for (name, digest, i) in children]
+
+
+class TestRcc(ProjectTestCase):
+
+    def test_qt_hash(self):
+        # the hashes in resource modules written by pyrcc4
+        self.assertEqual(pb_tool.qt_hash(u'plugins'), 0x073be0b3)
+        self.assertEqual(pb_tool.qt_hash(u'icon.png'), 0x0a615aa7)
+        self.assertEqual(pb_tool.qt_hash(u''), 0)
+
+    def check_icon(self, resources):
+        (flags, payload) = resources.find('/plugins/TestPlugin/icon.png')
+        with open('icon.png', 'rb') as f:
+            content = f.read()
+        # stored like qCompress: the size, then the zlib stream
+        self.assertEqual(flags, pb_tool.RCC_COMPRESSED)
+        self.assertEqual(struct.unpack('>I', payload[:4])[0], len(content))
+        self.assertEqual(zlib.decompress(payload[4:]), content)
+
+    def test_binary(self):
+        pb_tool.compile_qrc('resources.qrc', 'resources.rcc', binary=True)
+        with open('resources.rcc', 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:4], 'qres')
+        (version, tree, payloads, names) = struct.unpack('>IIII', data[4:20])
+        self.assertEqual(version, 1)
+        self.assertEqual(payloads, 20)
+        self.check_icon(ResourceTree(data[tree:], data[names:tree],
+                                     data[payloads:names]))
+
+    def test_module(self):
+        pb_tool.compile_qrc('resources.qrc', 'resources_rc.py')
+        with open('resources_rc.py') as f:
+            source = f.read()
+        sections = dict(
+            (name, eval('"{0}"'.format(literal)))
+            for (name, literal) in re.findall(
+                r'^qt_resource_(\w+) = "(.*?)"$', source, re.M | re.S))
+        self.check_icon(ResourceTree(sections['struct'], sections['name'],
+                                     sections['data']))
+        self.assertEqual(sections['name'][:20],
+                         '\x00\x07\x07\x3b\xe0\xb3\x00p\x00l\x00u'
+                         '\x00g\x00i\x00n\x00s')
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'TestPlugin')
+        os.makedirs(os.path.join(self.source, 'help', 'empty'))
+        self.files = {
+            'text.txt': ''.join('line {0}\n'.format(i) for i in range(5000)),
+            'random.bin': os.urandom(5000),
+            'icon.png': 'x' * 3000,
+            'empty.txt': '',
+            'help/index.html': '<p>help</p>' * 50}
+        for (name, content) in self.files.items():
+            with open(os.path.join(self.source, *name.split('/')), 'wb') as f:
+                f.write(content)
+        # several chunks for the larger members
+        self.chunk_size = pb_tool.ARCHIVE_CHUNK_SIZE
+        pb_tool.ARCHIVE_CHUNK_SIZE = 1024
+
+    def tearDown(self):
+        pb_tool.ARCHIVE_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.root)
+
+    def test_crc32_combine(self):
+        data = os.urandom(5000)
+        for split in [0, 1, 1024, 4999, 5000]:
+            (first, second) = (data[:split], data[split:])
+            self.assertEqual(
+                pb_tool.crc32_combine(zlib.crc32(first) & 0xffffffff,
+                                      zlib.crc32(second) & 0xffffffff,
+                                      len(second)),
+                zlib.crc32(data) & 0xffffffff)
+
+    def test_write_archive(self):
+        zip_path = os.path.join(self.root, 'TestPlugin.zip')
+        (count, size, compressed) = pb_tool.write_archive(
+            zip_path, self.source, 'TestPlugin', jobs=3)
+        self.assertEqual(count, len(self.files))
+        self.assertEqual(size, sum(len(content)
+                                   for content in self.files.values()))
+        archive = zipfile.ZipFile(zip_path)
+        try:
+            self.assertIsNone(archive.testzip())
+            infos = dict((info.filename, info) for info in archive.infolist())
+            for (name, content) in self.files.items():
+                self.assertEqual(archive.read('TestPlugin/' + name), content)
+            self.assertIn('TestPlugin/help/empty/', infos)
+            self.assertEqual(compressed, sum(
+                info.compress_size for info in infos.values()))
+        finally:
+            archive.close()
+        # the local headers are patched with the crc and sizes
+        with open(zip_path, 'rb') as f:
+            for info in infos.values():
+                f.seek(info.header_offset + 14)
+                self.assertEqual(struct.unpack('<III', f.read(12)),
+                                 (info.CRC, info.compress_size,
+                                  info.file_size))
+        stored = set(name for (name, info) in infos.items()
+                     if info.compress_type == zipfile.ZIP_STORED and
+                     not name.endswith('/'))
+        # png is stored as it is; deflating doesn't shrink the others
+        self.assertEqual(stored, set(['TestPlugin/icon.png',
+                                      'TestPlugin/random.bin',
+                                      'TestPlugin/empty.txt']))
+
+
+class TestIgnoreRules(unittest.TestCase):
+
+    # (patterns, path, is_dir, ignored)
+    IGNORED = [
+        (['*.pyc'], 'a.pyc', False, True),
+        (['*.pyc'], 'lib/a.pyc', False, True),
+        (['docs/*.txt'], 'docs/a.txt', False, True),
+        (['docs/*.txt'], 'docs/x/a.txt', False, False),
+        (['doc?.txt'], 'docs.txt', False, True),
+        (['doc?.txt'], 'doc/.txt', False, False),
+        (['f[!0-9].txt'], 'fa.txt', False, True),
+        (['f[!0-9].txt'], 'f1.txt', False, False),
+        # **
+        (['**/cache'], 'cache', True, True),
+        (['**/cache'], 'a/b/cache', True, True),
+        (['**/a/cache'], 'x/a/cache', True, True),
+        (['**/a/cache'], 'x/b/cache', True, False),
+        (['a/**/b'], 'a/b', False, True),
+        (['a/**/b'], 'a/x/y/b', False, True),
+        (['a/**/b'], 'ab', False, False),
+        (['a/**'], 'a/x/y', False, True),
+        (['a/**'], 'b/a/x', False, False),
+        # leading /
+        (['/build'], 'build', True, True),
+        (['/build'], 'sub/build', True, False),
+        (['build'], 'sub/build', True, True),
+        # trailing /
+        (['fixtures/'], 'fixtures', True, True),
+        (['fixtures/'], 'fixtures', False, False),
+        (['test/fixtures/'], 'test/fixtures', True, True),
+        # negation, the last matching rule wins
+        (['*.txt', '!keep.txt'], 'keep.txt', False, False),
+        (['*.txt', '!keep.txt'], 'drop.txt', False, True),
+        (['!keep.txt', '*.txt'], 'keep.txt', False, True),
+    ]
+
+    def test_is_ignored(self):
+        for (patterns, path, is_dir, ignored) in self.IGNORED:
+            rules = [pb_tool.ignore_rule(pattern) for pattern in patterns]
+            self.assertEqual(pb_tool.is_ignored(path, is_dir, rules), ignored,
+                             (patterns, path, is_dir))
+
+    # (patterns, file path, included)
+    INCLUDED = [
+        (['*.html'], 'index.html', True),
+        (['*.html'], '_static/a.css', False),
+        (['_static/'], '_static/a.css', True),
+        (['_static/'], '_static/img/a.png', True),
+        (['_static/'], '_static', False),
+        (['/_static/'], 'x/_static/a.css', False),
+        (['_static/', '!*.map'], '_static/a.css.map', False),
+        (['img/**/*.png'], 'img/a/b.png', True),
+    ]
+
+    def test_is_included(self):
+        for (patterns, path, included) in self.INCLUDED:
+            rules = [pb_tool.ignore_rule(pattern) for pattern in patterns]
+            self.assertEqual(pb_tool.is_included(path, rules), included,
+                             (patterns, path))
+
+    def test_include_directory(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name in ['index.html', 'notes.txt', '_static/a.css',
+                         '_static/img/b.png']:
+                path = os.path.join(root, *name.split('/'))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            include = [pb_tool.ignore_rule(pattern)
+                       for pattern in ['*.html', '_static/']]
+            items = pb_tool.tree_files(root, 'help', ([], include))
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(sorted(target for (source, target) in items),
+                         [os.path.join('help', '_static', 'a.css'),
+                          os.path.join('help', '_static', 'img', 'b.png'),
+                          os.path.join('help', 'index.html')])
+
+
+if __name__ == '__main__':
+    unittest.main()